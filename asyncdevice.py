@@ -0,0 +1,199 @@
+import asyncio
+import datetime
+import threading
+import numpy as np
+import serial
+from logger import Keithley
+
+
+class AsyncSerialTransport:
+    """
+    asyncio serial connection built on the optional serial_asyncio package (pyserial-asyncio). Every read is bounded
+    by timeout seconds using asyncio.wait_for so that a hung instrument raises serial.SerialTimeoutException, which
+    the AcquisitionWorker already handles, and a pending read can be cancelled with its task. limit is the longest
+    line in bytes which read_until accepts, longer responses raise serial.SerialException.
+    """
+    def __init__(self, port, baud_rate=9600, timeout=15, limit=2 ** 16):
+        self.port = port
+        self.baud_rate = baud_rate
+        self.timeout = timeout
+        self.limit = limit
+        self.reader = None
+        self.writer = None
+
+    async def open(self):
+        import serial_asyncio  # Optional dependency, only needed for asyncio communication
+        self.reader, self.writer = await serial_asyncio.open_serial_connection(url=self.port, baudrate=self.baud_rate,
+                                                                               limit=self.limit)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            self.reader = None
+
+    async def write(self, data):
+        self.writer.write(data)
+        await self.wait(self.writer.drain())
+
+    async def read_until(self, terminator=b"\r"):
+        return await self.wait(self.reader.readuntil(terminator))
+
+    async def read_exactly(self, n_bytes):
+        return await self.wait(self.reader.readexactly(n_bytes))
+
+    async def wait(self, awaitable):
+        try:
+            return await asyncio.wait_for(awaitable, self.timeout)
+        except asyncio.TimeoutError:
+            raise serial.SerialTimeoutException(f'No response from {self.port} within {self.timeout} s')
+        except asyncio.IncompleteReadError as e:
+            raise serial.SerialException(f'Connection to {self.port} closed: {e}')
+        except asyncio.LimitOverrunError as e:
+            raise serial.SerialException(f'Response from {self.port} longer than {self.limit} bytes: {e}')
+
+
+class AsyncKeithley(Keithley):
+    """
+    Keithley communicating through an AsyncSerialTransport. The methods which talk to the instrument are coroutines
+    so that many instruments can share one event loop. Instead of sleeping after every setup command, commands are
+    sent back to back and followed by an *OPC? query which the Keithley only answers once all of them are processed.
+    The connection is opened by await open() rather than in __init__. In buffered mode the line length limit of the
+    connection is sized to hold an ASCII transfer of the whole trace buffer. All other behaviour, including buffered
+    mode, binary transfer and scan scheduling, is that of Keithley.
+    The Logger only drives blocking devices and rejects an AsyncKeithley given directly, to log from one wrap it in a
+    SyncKeithley running on an EventLoopThread.
+    """
+    ascii_value_bytes = 32  # Upper bound of the length of one ASCII value with units and separator
+
+    def connect(self):
+        limit = 2 ** 16
+        if self.buffered:
+            # TRAC:DATA? returns a reading and a timestamp for each point of the buffer on a single line
+            limit = max(limit, 2 * self.max_buffer_points * self.ascii_value_bytes)
+        self.serial = AsyncSerialTransport(self.port, self.baud_rate, timeout=self.timeout, limit=limit)
+
+    async def open(self):
+        await self.serial.open()
+        print(f'Connected to device at {self.port}')
+        commands = list(self.preamble)
+        if self.data_format != 'ASCII':
+            commands.extend(self.format_cmds())
+        await self.write(commands)
+        await self.wait_complete()
+
+    async def close(self):
+        await self.serial.close()
+
+    async def write(self, command):
+        # Write a single string or a list of strings to the device
+        if isinstance(command, list):
+            for cmd in command:
+                await self.write(cmd)
+        else:
+            if not self.quiet:
+                print(f'writing: {command}')
+            await self.serial.write(f'{command}\n'.encode())
+
+    async def query(self, command):
+        await self.write(command)
+        return (await self.serial.read_until(b"\r")).decode().strip()
+
+    async def wait_complete(self):
+        # *OPC? is answered with 1 once all previous commands have been processed
+        response = await self.query("*OPC?")
+        if response != '1':
+            raise ValueError(f'unexpected response to *OPC?: {response}')
+
+    async def read(self):
+        due = self.due_channels()
+        scan = np.full(self.n_channels, np.nan)
+        if not due:
+            return scan
+        await self.write(self.scan_list_cmds([chan.hard_port for chan in due]))
+        scan[[chan.chan_idx for chan in due]] = await self.query_values("READ?", len(due))
+        return scan
+
+    async def query_values(self, command, n_values):
+        if self.data_format == 'ASCII':
+            return self.parse_ascii(await self.query(command))
+        await self.write(command)
+        n_bytes = n_values * self.binary_sizes[self.data_format]
+        header = await self.serial.read_exactly(2)
+        payload = await self.serial.read_exactly(n_bytes)
+        await self.serial.read_until(b"\r")
+        if header != b'#0':
+            raise ValueError(f'expected {n_bytes} bytes of {self.data_format} data, received {header + payload}')
+        return self.parse_binary(payload)
+
+    async def read_block(self):
+        if not self.buffered:
+            curr_datetime = datetime.datetime.now()
+            return [curr_datetime], [await self.read()]
+
+        points_stored = int(await self.query("TRAC:POIN:ACT?"))
+        if points_stored < self.buffer_points:
+            return [], []
+        data = await self.query_values("TRAC:DATA?", 2 * self.buffer_points)
+        buffer_start = self.buffer_start
+        await self.arm_buffer()
+        return self.parse_buffer(data, buffer_start)
+
+    async def arm_buffer(self):
+        await self.write(self.arm_cmds)
+        self.buffer_start = datetime.datetime.now()
+
+    async def init_measurement(self, channels, tick_interval=None):
+        await self.write(self.measurement_cmds(channels))
+        if self.buffered:
+            await self.write(self.buffer_cmds())
+            await self.wait_complete()
+            print(f'Initialized trace buffer for {self.buffer_scans:d} scans every {self.scan_interval} s')
+            await self.arm_buffer()
+        else:
+            await self.wait_complete()
+        if tick_interval is not None:
+            self.check_schedule(tick_interval)
+
+
+class EventLoopThread(threading.Thread):
+    """
+    Runs an asyncio event loop in a daemon thread which can be shared by several devices. run_sync() runs a coroutine
+    on the loop and blocks until it is done.
+    """
+    def __init__(self):
+        super(EventLoopThread, self).__init__(name='asyncio event loop', daemon=True)
+        self.loop = asyncio.new_event_loop()
+        self.start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run_sync(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.join()
+
+
+class SyncKeithley:
+    """
+    Blocking facade over an AsyncKeithley running on a shared EventLoopThread, with the interface the Logger expects
+    of a device. This lets asyncio instruments be used with the threaded Logger and AcquisitionWorkers unchanged.
+    Each read still blocks the AcquisitionWorker of the device until the coroutine on the loop has completed.
+    """
+    def __init__(self, async_keithley, event_loop_thread):
+        self.device = async_keithley
+        self.event_loop_thread = event_loop_thread
+        self.event_loop_thread.run_sync(self.device.open())
+
+    def init_measurement(self, channels, tick_interval=None):
+        self.event_loop_thread.run_sync(self.device.init_measurement(channels, tick_interval=tick_interval))
+
+    def read_block(self):
+        return self.event_loop_thread.run_sync(self.device.read_block())
+
+    def close(self):
+        self.event_loop_thread.run_sync(self.device.close())
@@ -0,0 +1,244 @@
+import os
+import json
+import hashlib
+import datetime
+from pathlib import Path
+import numpy as np
+
+raw_suffix = ' raw'  # Suffix of the columns holding the raw readings of channels
+
+
+class LinearConversion:
+    """
+    Converts raw readings x to scale * x + offset.
+    """
+    def __init__(self, scale=1.0, offset=0.0):
+        self.scale = scale
+        self.offset = offset
+
+    def __call__(self, raw):
+        return raw * self.scale + self.offset
+
+    def __repr__(self):
+        return f'LinearConversion(scale={self.scale!r}, offset={self.offset!r})'
+
+    def to_dict(self):
+        return {'type': 'linear', 'scale': self.scale, 'offset': self.offset}
+
+
+class LogDecadeConversion:
+    """
+    Converts logarithmic readings x with volts_per_decade and the reading offset at a value of scale to
+    scale * 10 ** ((x - offset) / volts_per_decade).
+    """
+    def __init__(self, volts_per_decade=1.0, offset=0.0, scale=1.0):
+        self.volts_per_decade = volts_per_decade
+        self.offset = offset
+        self.scale = scale
+
+    def __call__(self, raw):
+        return self.scale * 10 ** ((raw - self.offset) / self.volts_per_decade)
+
+    def __repr__(self):
+        return (f'LogDecadeConversion(volts_per_decade={self.volts_per_decade!r}, offset={self.offset!r}, '
+                f'scale={self.scale!r})')
+
+    def to_dict(self):
+        return {'type': 'log_decade', 'volts_per_decade': self.volts_per_decade, 'offset': self.offset,
+                'scale': self.scale}
+
+
+class UfuncConversion:
+    """
+    Converts raw readings with func which must accept and return numpy arrays, e.g. a numpy ufunc or a function built
+    from numpy operations. Plain callables given as conversions are wrapped in a UfuncConversion.
+    """
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, raw):
+        return self.func(raw)
+
+    def __repr__(self):
+        return f'UfuncConversion({self.func!r})'
+
+    def to_dict(self):
+        # Only numpy ufuncs can be stored, by name
+        if not isinstance(self.func, np.ufunc) or getattr(np, self.func.__name__, None) is not self.func:
+            raise ValueError(f'Only numpy ufuncs can be stored, not {self.func!r}')
+        return {'type': 'ufunc', 'name': self.func.__name__}
+
+
+class BlockConversion:
+    """
+    Converts blocks of scans, arrays of shape (n_scans, n_readings), into arrays of shape (n_scans, n_channels)
+    holding the converted value of each channel. The linear conversions of all channels are applied together as a
+    single array operation, the remaining conversions are applied to the whole column of their channel at once.
+    """
+    def __init__(self, conversions, indices):
+        self.n_channels = len(conversions)
+        linear = [n for n, conversion in enumerate(conversions) if isinstance(conversion, LinearConversion)]
+        self.linear_columns = np.array(linear, dtype=np.intp)
+        self.linear_indices = np.array([indices[n] for n in linear], dtype=np.intp)
+        self.scales = np.array([conversions[n].scale for n in linear], dtype=np.float64)
+        self.offsets = np.array([conversions[n].offset for n in linear], dtype=np.float64)
+        self.other = [(n, indices[n], as_conversion(conversion)) for n, conversion in enumerate(conversions)
+                      if n not in linear]
+
+    def __call__(self, block):
+        block = np.asarray(block, dtype=np.float64).reshape(-1, np.shape(block)[-1])
+        converted = np.empty((block.shape[0], self.n_channels), dtype=np.float64)
+        converted[:, self.linear_columns] = block[:, self.linear_indices] * self.scales + self.offsets
+        for column, index, conversion in self.other:
+            converted[:, column] = conversion(block[:, index])
+        return converted
+
+
+def as_conversion(conversion):
+    # Conversion specs are used as they are, any other callable is treated as a ufunc
+    if isinstance(conversion, (LinearConversion, LogDecadeConversion, UfuncConversion)):
+        return conversion
+    return UfuncConversion(conversion)
+
+
+def conversion_from_dict(spec):
+    spec = dict(spec)
+    conversion_type = spec.pop('type')
+    if conversion_type == 'linear':
+        return LinearConversion(**spec)
+    elif conversion_type == 'log_decade':
+        return LogDecadeConversion(**spec)
+    elif conversion_type == 'ufunc':
+        return UfuncConversion(getattr(np, spec['name']))
+    raise ValueError(f'Unknown conversion type {conversion_type}')
+
+
+def raw_field(chan_name):
+    return f'{chan_name}{raw_suffix}'
+
+
+class ConversionRegistry:
+    """
+    Versioned record of the conversion of each channel, stored as .json in file_path. Every channel has a list of
+    conversions each valid from a datetime onwards. When raw readings are saved (SaveGroup(save_raw=True)) the
+    Loader uses the registry to recompute the converted values from the raw columns on read, so that a calibration
+    can be fixed for data that was already logged by registering a corrected conversion with an earlier valid_from,
+    without rewriting any data files. version changes whenever the registry does so that caches of converted data
+    are not reused. sync() merges two copies of the registry, e.g. a local copy and the copy on the log drive.
+    """
+    datetime_format = '%Y-%m-%d %H:%M:%S'
+
+    def __init__(self, file_path):
+        self.file_path = Path(file_path)
+        self.entries = dict()
+        self.version = None
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.file_path, 'r') as file:
+                self.entries = json.load(file)
+        except FileNotFoundError:
+            self.entries = dict()
+        self.update_version()
+
+    def save(self, file_path=None):
+        # Written atomically so that Loaders never read a partially written registry
+        file_path = self.file_path if file_path is None else Path(file_path)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = file_path.with_name(f'{file_path.name}.tmp')
+        with open(tmp_path, 'w') as file:
+            json.dump(self.entries, file, indent=2, sort_keys=True)
+        os.replace(tmp_path, file_path)
+
+    def sync(self, file_path):
+        """
+        Merges the copy of the registry in file_path into this one and writes the merged registry to both files.
+        Entries of the other copy are added where this registry has no entry with the same valid_from, so that no
+        conversion registered in either copy is lost. Raises OSError if file_path can't be read or written.
+        """
+        try:
+            with open(file_path, 'r') as file:
+                other_entries = json.load(file)
+        except FileNotFoundError:
+            other_entries = dict()
+        if self.merge(other_entries):
+            self.save()
+        self.save(file_path)
+
+    def merge(self, other_entries):
+        # Returns whether any entries were added. A new dict is built so that concurrent apply() calls are unaffected.
+        entries = {chan_name: list(chan_entries) for chan_name, chan_entries in self.entries.items()}
+        changed = False
+        for chan_name, other_chan_entries in other_entries.items():
+            chan_entries = entries.setdefault(chan_name, [])
+            valid_froms = {entry['valid_from'] for entry in chan_entries}
+            new_entries = [entry for entry in other_chan_entries if entry['valid_from'] not in valid_froms]
+            if new_entries:
+                chan_entries.extend(new_entries)
+                chan_entries.sort(key=lambda entry: entry['valid_from'])
+                changed = True
+        if changed:
+            self.entries = entries
+            self.update_version()
+        return changed
+
+    def update_version(self):
+        self.version = hashlib.sha1(json.dumps(self.entries, sort_keys=True).encode()).hexdigest()
+
+    def register(self, chan_name, conversion, valid_from):
+        # Add a conversion for chan_name valid from valid_from onwards, replacing any conversion from the same time
+        valid_from = valid_from.strftime(self.datetime_format)
+        entries = [entry for entry in self.entries.get(chan_name, []) if entry['valid_from'] != valid_from]
+        entries.append({'valid_from': valid_from, 'conversion': as_conversion(conversion).to_dict()})
+        self.entries[chan_name] = sorted(entries, key=lambda entry: entry['valid_from'])
+        self.update_version()
+
+    def current(self, chan_name):
+        # The most recently registered conversion of chan_name or None
+        entries = self.entries.get(chan_name)
+        if not entries:
+            return None
+        return conversion_from_dict(entries[-1]['conversion'])
+
+    def ensure(self, chan_name, conversion, valid_from):
+        # Register conversion unless it is already the current conversion of chan_name. Returns whether it changed.
+        spec = as_conversion(conversion).to_dict()
+        entries = self.entries.get(chan_name)
+        if entries and entries[-1]['conversion'] == spec:
+            return False
+        self.register(chan_name, conversion, valid_from)
+        return True
+
+    def apply(self, data):
+        """
+        Returns data with the converted columns recomputed from the raw columns using the conversions valid at the
+        time of each row. Rows before the first registered conversion, rows without a raw reading and channels
+        without raw columns keep their stored values.
+        """
+        if data.shape[0] == 0 or not self.entries:
+            return data
+        data = data.copy()
+        times = data.index.values
+        for chan_name, entries in self.entries.items():
+            raw_column = raw_field(chan_name)
+            if raw_column not in data.columns:
+                continue
+            raw = data[raw_column].to_numpy(dtype=np.float64)
+            if chan_name in data.columns:
+                converted = data[chan_name].to_numpy(dtype=np.float64, copy=True)
+            else:
+                converted = np.full(raw.shape, np.nan)
+            valid_froms = np.array([np.datetime64(datetime.datetime.strptime(entry['valid_from'],
+                                                                             self.datetime_format), 'ns')
+                                    for entry in entries])
+            bounds = np.append(np.searchsorted(times, valid_froms), len(times))
+            for entry, start, stop in zip(entries, bounds[:-1], bounds[1:]):
+                if start == stop:
+                    continue
+                segment = raw[start:stop]
+                has_raw = ~np.isnan(segment)
+                conversion = conversion_from_dict(entry['conversion'])
+                converted[start:stop] = np.where(has_raw, conversion(segment), converted[start:stop])
+            data[chan_name] = converted
+        return data
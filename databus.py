@@ -0,0 +1,74 @@
+import threading
+import numpy as np
+import pandas as pd
+
+
+class DataBus:
+    """
+    In-process publish/subscribe bus between the Logger and the PlotWindows. The Logger publishes every converted scan
+    of each save group and the bus keeps the most recent scans of each group in a RingBuffer so that plots tracking
+    the present moment can be served from memory instead of re-reading what was just written to disk.
+    """
+    def __init__(self, capacity=20000):
+        self.capacity = capacity
+        self.rings = dict()
+        self.lock = threading.Lock()
+
+    def publish(self, group_name, curr_datetime, values):
+        ring = self.ring(group_name, fields=list(values.keys()))
+        ring.append(curr_datetime, [values[field] for field in ring.fields])
+
+    def ring(self, group_name, fields=None):
+        # Returns the RingBuffer for group_name, creating it if fields are given. None if the group is unknown.
+        with self.lock:
+            ring = self.rings.get(group_name)
+            if ring is None and fields is not None:
+                ring = RingBuffer(fields, capacity=self.capacity)
+                self.rings[group_name] = ring
+            return ring
+
+
+class RingBuffer:
+    """
+    Fixed capacity buffer of the most recent scans of a save group. The timestamps and values are held in
+    preallocated numpy arrays which are overwritten oldest first once the buffer is full. Appending happens in the
+    logging thread and reading in the plot loading threads so all access is done under a lock.
+    """
+    def __init__(self, fields, capacity=20000):
+        self.fields = list(fields)
+        self.capacity = capacity
+        self.times = np.empty(self.capacity, dtype='datetime64[ns]')
+        self.values = np.empty((self.capacity, len(self.fields)), dtype=np.float64)
+        self.n_rows = 0
+        self.head = 0  # Index at which the next row will be written
+        self.lock = threading.Lock()
+
+    def append(self, curr_datetime, values):
+        with self.lock:
+            self.times[self.head] = np.datetime64(curr_datetime, 'ns')
+            self.values[self.head] = values
+            self.head = (self.head + 1) % self.capacity
+            self.n_rows = min(self.n_rows + 1, self.capacity)
+
+    def start_datetime(self):
+        # Timestamp of the oldest row in the buffer or None if it is empty.
+        with self.lock:
+            if self.n_rows == 0:
+                return None
+            return pd.Timestamp(self.times[(self.head - self.n_rows) % self.capacity]).to_pydatetime()
+
+    def frame(self, start_datetime=None):
+        """
+        Returns the buffered rows in time order as a pandas data frame indexed by datetime in the same layout as the
+        data returned by the Loader. If start_datetime is given only rows from start_datetime onwards are returned.
+        """
+        with self.lock:
+            order = (np.arange(self.head - self.n_rows, self.head)) % self.capacity
+            times = self.times[order]
+            values = self.values[order]
+        if start_datetime is not None:
+            first = np.searchsorted(times, np.datetime64(start_datetime, 'ns'))
+            times = times[first:]
+            values = values[first:]
+        index = pd.DatetimeIndex(times, name='datetime')
+        return pd.DataFrame(values, index=index, columns=self.fields)
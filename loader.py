@@ -1,24 +1,69 @@
+import os
+import threading
 import numpy as np
 import pandas as pd
 import datetime
 from pathlib import Path
 import csv
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from storage import CsvStorage
+from conversion import raw_suffix
 
 
 class Loader:
-    def __init__(self, log_drive, file_prefix, date_format='%Y-%m-%d', time_format='%H:%M:%S', quiet=True):
+    """
+    Loads logged data for a single SaveGroup from the log drive. Multi-day ranges are read by a pool of max_workers
+    threads, or processes if use_processes is True which also parallelizes the parsing, and reassembled in date order.
+    If cache_drive is given, the parsed data of each completed day is stored there in a binary .npz sidecar file which
+    is used instead of the log file on later loads for as long as the size and modification time of the log file are
+    unchanged. Completed days are also kept in day_cache, by default the DayCache shared by all Loaders in the process,
+    so that switching between views or revisiting recently viewed days doesn't touch the disk at all.
+    For long histories grab_level and refresh_level return min/max aggregates over buckets of one of the resolutions
+    instead of the raw data. The aggregates of completed days are computed once and kept in the day cache and, if
+    cache_drive is given, in a level sidecar per day and resolution next to the .npz sidecars.
+    """
+    def __init__(self, log_drive, file_prefix, date_format='%Y-%m-%d', time_format='%H:%M:%S', storage=None,
+                 max_workers=4, use_processes=False, cache_drive=None, day_cache=None,
+                 resolutions=('1min', '10min', '1h'), conversions=None, quiet=True):
 
         self.log_drive = log_drive
         self.file_prefix = file_prefix
         self.date_format = date_format
         self.time_format = time_format
         self.datetime_format = f'{self.date_format} {self.time_format}'
+        self.storage = storage
+        if self.storage is None:
+            self.storage = CsvStorage(date_format=self.date_format, time_format=self.time_format)
+        self.max_workers = max_workers
+        self.use_processes = use_processes
+        self.cache_drive = cache_drive
+        self.day_cache = day_cache
+        if self.day_cache is None:
+            self.day_cache = shared_day_cache
+        self.resolutions = sorted(pd.Timedelta(resolution) for resolution in resolutions)
+        self.conversions = conversions
         self.quiet = quiet
 
         self.data = None
+        self.buffer = FrameBuffer()
         self.loaded_start_date = None
         self.loaded_stop_date = None
-        self.lines_loaded = 0
+        self.offset_loaded = 0
+        self.history = None
+        self.history_start = None
+        self.history_stop = None
+
+    def __getstate__(self):
+        # The day cache holds a lock and is per process, a Loader sent to another process uses the day cache there
+        state = self.__dict__.copy()
+        state['day_cache'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.day_cache is None:
+            self.day_cache = shared_day_cache
 
     def grab_dates(self, start_date, stop_date):
         """
@@ -34,22 +79,9 @@ class Loader:
             print(f'Grabbing data for dates '
                   f'{start_date.strftime(self.date_format)} through {stop_date.strftime(self.date_format)}')
         t0 = datetime.datetime.now()
-        data = pd.DataFrame()
         date_range = [dt.date() for dt in pd.date_range(start_date, stop_date).to_pydatetime()]
-        for date in date_range:
-            date_str = date.strftime(self.date_format)
-            file_name = f'{self.file_prefix} {date_str}.csv'
-            file_path = Path(self.log_drive, file_name)
-            try:
-                new_data = pd.read_csv(file_path,
-                                       header=0,
-                                       parse_dates={'datetime': ['date', 'time']},
-                                       index_col='datetime',
-                                       infer_datetime_format=True)
-                new_data.index = pd.to_datetime(new_data.index, format=self.datetime_format)
-                data = data.append(new_data)
-            except FileNotFoundError:
-                print(f'File not found: {file_path}')
+        chunks = self.read_days(date_range)
+        data = concat_chunks(chunks)
         if not self.quiet:
             tf = datetime.datetime.now()
             dt = (tf-t0).total_seconds()
@@ -63,10 +95,10 @@ class Loader:
         """
         refresh_data parses through the data log returning a pandas data frame which contains all of the data
         from start_datetime.date() through the present moment. The Loader class keeps track of which data has
-        previously been loaded by saving previously loaded data in self.data and keeping track of how many
-        lines of data have already been read in from the data file corresponding to the present day in
-        self.lines_loaded. Correspondingly there are chains of logic to ensure this method exhibits the
-        appropriate behaviour depending on the state of the data log and the data which is loaded into self.data
+        previously been loaded by saving previously loaded data in self.buffer and keeping track of the offset
+        (bytes for .csv files) up to which the data file corresponding to the present day has already been read in
+        self.offset_loaded. Correspondingly there are chains of logic to ensure this method exhibits the
+        appropriate behaviour depending on the state of the data log and the data which is loaded into self.buffer
         and the time period for which data is being requested.
         """
         start_date = start_datetime.date()
@@ -80,7 +112,7 @@ class Loader:
         t0 = datetime.datetime.now()
 
         # If no data is loaded of if the data range being requested ranges to a time earlier than the
-        # start of the loaded data a `hard reset' is required. A hard reset simply involves clearing self.data
+        # start of the loaded data a `hard reset' is required. A hard reset simply involves clearing self.buffer
         # and resetting some flags.
         hard_reset = False
         if self.loaded_start_date is None:
@@ -90,15 +122,13 @@ class Loader:
                 hard_reset = True
             elif self.loaded_start_date < start_date:
                 # Remove data from dates older than the range which is being requested to save memory
-                time_mask = np.logical_and(np.array(start_datetime <= self.data.index),
-                                           np.array(self.data.index <= stop_datetime))
-                self.data = self.data.loc[time_mask]
+                self.buffer.trim(start_datetime)
                 self.loaded_start_date = start_datetime.date()
         if hard_reset:
-            self.data = pd.DataFrame()
+            self.buffer = FrameBuffer()
             self.loaded_start_date = None
             self.loaded_stop_date = None
-            self.lines_loaded = 0
+            self.offset_loaded = 0
 
         date_range = [dt.date() for dt in pd.date_range(start_date, stop_date).to_pydatetime()]
         for date in date_range:
@@ -106,36 +136,32 @@ class Loader:
                 pass
             else:
                 if date < self.loaded_stop_date:
-                    # dates with date < self.loaded_stop_date should already be included in self.data.
+                    # dates with date < self.loaded_stop_date should already be included in self.buffer.
                     # Skip to next date.
                     continue
                 elif date > self.loaded_stop_date:
                     # if date > self.loaded_stop_date it means we have moved onto a new file
                     # and must start reading at the beginning.
-                    self.lines_loaded = 0
+                    self.offset_loaded = 0
                 elif date == self.loaded_stop_date:
-                    # if date == self.loaded_stop_date then current value of self.lines_loaded
+                    # if date == self.loaded_stop_date then current value of self.offset_loaded
                     # will be used to load only recent data.
                     pass
-            date_str = date.strftime(self.date_format)
-            file_name = f'{self.file_prefix} {date_str}.csv'
-            file_path = Path(self.log_drive, file_name)
-            try:
-                # Load in new data. Note that lines up until line number self.lines_loaded are skipped
-                new_data = pd.read_csv(file_path,
-                                       header=0,
-                                       skiprows=range(1, self.lines_loaded + 1),
-                                       parse_dates={'datetime': ['date', 'time']},
-                                       index_col='datetime',
-                                       infer_datetime_format=True)
-                new_data.index = pd.to_datetime(new_data.index, format=self.datetime_format)
-                new_row_count = new_data.shape[0]
-                if new_row_count > 0:
-                    self.data = self.data.append(new_data)
-                if date == stop_date:
-                    self.lines_loaded += new_row_count
-            except FileNotFoundError:
-                print(f'File not found: {file_path}')
+            file_path = self.file_path(date)
+            if date < stop_date and self.offset_loaded == 0:
+                # Past days are complete so can be loaded in one go, using the sidecar cache if available
+                self.buffer.append(self.read_days([date])[0])
+            else:
+                try:
+                    # Load in new data. Note that only data after self.offset_loaded is read
+                    new_data, new_offset = self.storage.read_tail(file_path, offset=self.offset_loaded)
+                    if self.conversions is not None:
+                        new_data = self.conversions.apply(new_data)
+                    self.buffer.append(new_data)
+                    if date == stop_date:
+                        self.offset_loaded = new_offset
+                except FileNotFoundError:
+                    print(f'File not found: {file_path}')
             if self.loaded_start_date is None:
                 self.loaded_start_date = date
             self.loaded_stop_date = date
@@ -147,11 +173,381 @@ class Loader:
                   f'{start_date.strftime(self.date_format)} through '
                   f'{stop_date.strftime(self.date_format)}')
             print(f'Refreshing took {dt:.3f} s')
+        self.data = self.buffer.frame()
+        return self.data
+
+    def refresh_live(self, start_datetime, ring):
+        """
+        Same as refresh_data but serves the most recent data from ring, a RingBuffer holding the scans published by
+        the Logger. Only history older than the ring is read from disk. That history is kept in self.history and only
+        re-read when start_datetime moves before it or the ring has moved on past the end of it, so in steady state
+        refreshing doesn't touch the disk at all.
+        """
+        ring_start = ring.start_datetime()
+        if ring_start is None:
+            return self.refresh_data(start_datetime)
+        live_data = ring.frame(start_datetime)
+        if start_datetime >= ring_start:
+            self.data = live_data
+            return self.data
+        if self.history is None or start_datetime < self.history_start or self.history_stop < ring_start:
+            self.history_stop = datetime.datetime.now()
+            self.history = self.refresh_data(start_datetime)
+            self.history_start = start_datetime
+        history = self.history.loc[start_datetime:]
+        history = history.iloc[:history.index.searchsorted(ring_start)]
+        self.data = concat_chunks([history, live_data])
         return self.data
 
+    def select_resolution(self, time_span, n_pixels):
+        """
+        Returns the coarsest resolution whose buckets are no wider than one pixel when time_span is drawn across
+        n_pixels, so that the min/max points still give one to two points per pixel. Returns None if even the finest
+        resolution is too coarse, in which case the raw data should be used.
+        """
+        time_per_pixel = time_span / max(n_pixels, 1)
+        suitable = [resolution for resolution in self.resolutions if resolution <= time_per_pixel]
+        if not suitable:
+            return None
+        return suitable[-1]
+
+    def grab_level(self, start_date, stop_date, resolution):
+        # Same as grab_dates but returns the min/max points of the aggregates at resolution
+        if isinstance(start_date, datetime.datetime):
+            start_date = start_date.date()
+        if isinstance(stop_date, datetime.datetime):
+            stop_date = stop_date.date()
+        date_range = [dt.date() for dt in pd.date_range(start_date, stop_date).to_pydatetime()]
+        return level_points(concat_chunks(self.read_levels(date_range, resolution)))
+
+    def refresh_level(self, start_datetime, resolution):
+        """
+        Same as refresh_data but returns the min/max points of the aggregates at resolution. Completed days come from
+        the cached aggregates while the present day is loaded incrementally by refresh_data and aggregated on the fly.
+        """
+        today = datetime.date.today()
+        past_dates = [dt.date() for dt in pd.date_range(start_datetime.date(), today).to_pydatetime()][:-1]
+        levels = self.read_levels(past_dates, resolution)
+        today_start = max(start_datetime, datetime.datetime.combine(today, datetime.time()))
+        levels.append(aggregate(self.refresh_data(today_start), resolution))
+        return level_points(concat_chunks(levels))
+
+    def read_levels(self, dates, resolution):
+        """
+        Returns the aggregates at resolution for each of dates. The aggregates of completed days are served from the
+        day cache or their level sidecar if possible, otherwise they are computed from the day data and cached in both.
+        Level sidecars hold converted data so they are only used with the conversions version they were written with.
+        """
+        levels = [None] * len(dates)
+        to_read = []
+        for n, date in enumerate(dates):
+            cache_key = self.cache_key(date)
+            level_path = None
+            if cache_key is not None:
+                cache_key = cache_key + (resolution,)
+                level_path = self.level_path(date, resolution)
+                levels[n] = self.day_cache.get(cache_key)
+                if levels[n] is None and level_path is not None:
+                    levels[n] = read_sidecar(level_path, cache_key[1], cache_key[2], self.conversions_version())
+                    if levels[n] is not None:
+                        self.day_cache.put(cache_key, levels[n])
+            if levels[n] is None:
+                to_read.append((n, date, cache_key, level_path))
+        data_frames = self.read_days([date for _, date, _, _ in to_read])
+        for (n, _, cache_key, level_path), data in zip(to_read, data_frames):
+            levels[n] = aggregate(data, resolution)
+            if cache_key is not None and levels[n].shape[0] > 0:
+                self.day_cache.put(cache_key, levels[n])
+                if level_path is not None:
+                    write_sidecar(level_path, levels[n], cache_key[1], cache_key[2], self.conversions_version())
+        return levels
+
+    def read_days(self, dates):
+        """
+        Returns the data frames for complete day files in the order of dates. Days found in the day cache are
+        served from memory, the remaining files are read concurrently and added to the cache.
+        """
+        data_frames = [None] * len(dates)
+        to_read = []
+        for n, date in enumerate(dates):
+            cache_key = self.cache_key(date)
+            if cache_key is not None:
+                data_frames[n] = self.day_cache.get(cache_key)
+            if data_frames[n] is None:
+                to_read.append((n, date, cache_key))
+
+        file_paths = [self.file_path(date) for _, date, _ in to_read]
+        sidecar_paths = [self.sidecar_path(date) for _, date, _ in to_read]
+        n_workers = min(self.max_workers, len(file_paths))
+        if n_workers <= 1:
+            new_data_frames = [read_file(self.storage, file_path, sidecar_path, self.conversions)
+                               for file_path, sidecar_path in zip(file_paths, sidecar_paths)]
+        else:
+            executor_class = ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
+            with executor_class(max_workers=n_workers) as executor:
+                new_data_frames = list(executor.map(read_file, [self.storage] * len(file_paths),
+                                                    file_paths, sidecar_paths,
+                                                    [self.conversions] * len(file_paths)))
+        for (n, _, cache_key), data in zip(to_read, new_data_frames):
+            data_frames[n] = data
+            if cache_key is not None and data.shape[0] > 0:
+                self.day_cache.put(cache_key, data)
+        return data_frames
+
+    def cache_key(self, date):
+        # Completed days are identified by path, size and modification time so that a changed file is never served
+        if date >= datetime.date.today():
+            return None
+        file_path = self.file_path(date)
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        if self.conversions is not None:
+            # Data converted with a different version of the conversions must not be served
+            return str(file_path), stat.st_size, stat.st_mtime_ns, self.conversions.version
+        return str(file_path), stat.st_size, stat.st_mtime_ns
+
+    def conversions_version(self):
+        return None if self.conversions is None else self.conversions.version
+
+    def sidecar_path(self, date):
+        # Only days which are over are cached since the file for the present day is still being written
+        if self.cache_drive is None or date >= datetime.date.today():
+            return None
+        return Path(self.cache_drive, f'{self.file_path(date).stem}.npz')
+
+    def level_path(self, date, resolution):
+        # Level sidecars are named after the day file and the bucket width in seconds
+        if self.cache_drive is None or date >= datetime.date.today():
+            return None
+        return Path(self.cache_drive, f'{self.file_path(date).stem} {int(resolution.total_seconds())}s.npz')
+
+    def file_path(self, date):
+        return Path(self.log_drive, self.storage.file_name(self.file_prefix, date))
+
     def get_header(self):
         file_path = list(Path(self.log_drive).glob('*.csv'))[0]  # extract header from first matching file
         with file_path.open('r', newline='') as file:
             reader = csv.reader(file)
             header = next(reader)
         return header
+
+    def get_fields(self):
+        # Returns the names of the data columns, extracted from the first matching file. Raw columns are left out.
+        file_path = list(Path(self.log_drive).glob(f'{self.file_prefix} *.{self.storage.extension}'))[0]
+        fields = self.storage.get_fields(file_path)
+        return [field for field in fields if not field.endswith(raw_suffix)]
+
+
+class FrameBuffer:
+    """
+    Growable buffer holding time indexed data with a set of float columns. Storage is preallocated and its
+    capacity doubled when full, so appending n rows costs O(n) amortized instead of copying all previously loaded
+    data as repeated concatenation would. Arrays are never modified below self.stop once written, and are reallocated
+    rather than compacted in place, so frames previously returned by frame() remain valid. Columns which first
+    appear in later data, e.g. after channels were added to a group, are added to the buffer filled with NaN for the
+    rows before them.
+    """
+    def __init__(self, capacity=1024):
+        self.columns = None
+        self.index = np.empty(capacity, dtype='datetime64[ns]')
+        self.values = None
+        self.start = 0
+        self.stop = 0
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def append(self, data):
+        n_rows = data.shape[0]
+        if n_rows == 0:
+            return
+        if self.columns is None:
+            self.columns = list(data.columns)
+            self.values = np.empty((len(self.index), len(self.columns)))
+        elif list(data.columns) != self.columns:
+            new_columns = [column for column in data.columns if column not in self.columns]
+            if new_columns:
+                self.widen(new_columns)
+            data = data.reindex(columns=self.columns)
+        self.reserve(n_rows)
+        self.index[self.stop:self.stop + n_rows] = data.index.values
+        self.values[self.stop:self.stop + n_rows] = data.to_numpy(dtype=np.float64)
+        self.stop += n_rows
+
+    def reserve(self, n_rows):
+        # Ensure there is room for n_rows more rows, reallocating with at least double the capacity if needed
+        if self.stop + n_rows <= len(self.index):
+            return
+        capacity = max(2 * len(self.index), len(self) + n_rows)
+        self.reallocate(capacity, slice(self.start, self.stop))
+
+    def widen(self, columns):
+        # Add columns filled with NaN. The values are copied to a new array so that previous frames remain valid.
+        values = np.full((len(self.index), len(self.columns) + len(columns)), np.nan)
+        values[:, :len(self.columns)] = self.values
+        self.values = values
+        self.columns = self.columns + list(columns)
+
+    def reallocate(self, capacity, selection):
+        index = self.index[selection]
+        values = self.values[selection]
+        self.index = np.empty(capacity, dtype='datetime64[ns]')
+        self.values = np.empty((capacity, len(self.columns)))
+        self.index[:len(index)] = index
+        self.values[:len(index)] = values
+        self.start = 0
+        self.stop = len(index)
+
+    def trim(self, start_datetime):
+        # Drop all rows older than start_datetime
+        if len(self) == 0:
+            return
+        keep = self.index[self.start:self.stop] >= np.datetime64(start_datetime)
+        first_keep = int(np.argmax(keep)) if keep.any() else len(keep)
+        if keep[first_keep:].all():
+            # Usual case of time ordered data, simply move the start of the buffer forward
+            self.start += first_keep
+        else:
+            self.reallocate(len(self.index), self.start + np.flatnonzero(keep))
+
+    def frame(self):
+        if self.columns is None:
+            return pd.DataFrame()
+        index = pd.DatetimeIndex(self.index[self.start:self.stop], name='datetime')
+        return pd.DataFrame(self.values[self.start:self.stop], index=index, columns=self.columns, copy=False)
+
+
+class DayCache:
+    """
+    Thread safe in-memory LRU cache of day data frames. When the total size of the cached frames exceeds max_bytes
+    the least recently used frames are evicted. Cached frames are shared between Loaders and must not be modified.
+    """
+    def __init__(self, max_bytes=512 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.data_frames = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.data_frames.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.data_frames.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, data):
+        n_bytes = int(data.memory_usage(index=True).sum())
+        if n_bytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.data_frames:
+                self.total_bytes -= self.data_frames.pop(key)[1]
+            self.data_frames[key] = (data, n_bytes)
+            self.total_bytes += n_bytes
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self.data_frames.popitem(last=False)
+                self.total_bytes -= evicted_bytes
+
+    def clear(self):
+        with self.lock:
+            self.data_frames.clear()
+            self.total_bytes = 0
+
+
+shared_day_cache = DayCache()
+
+
+def read_file(storage, file_path, sidecar_path=None, conversions=None):
+    # Module level so that it can be sent to worker processes. The sidecar holds the data as stored, before conversion.
+    try:
+        if sidecar_path is None:
+            data = storage.read(file_path)
+        else:
+            stat = os.stat(file_path)
+            data = read_sidecar(sidecar_path, stat.st_size, stat.st_mtime_ns)
+            if data is None:
+                data = storage.read(file_path)
+                write_sidecar(sidecar_path, data, stat.st_size, stat.st_mtime_ns)
+    except FileNotFoundError:
+        print(f'File not found: {file_path}')
+        return pd.DataFrame()
+    if conversions is not None:
+        data = conversions.apply(data)
+    return data
+
+
+def read_sidecar(sidecar_path, size, mtime_ns, version=None):
+    """
+    Returns the cached data frame, or None if there is no sidecar or it doesn't match the size and modification time
+    of the log file, or the conversions version if one is given.
+    """
+    try:
+        with np.load(sidecar_path, allow_pickle=False) as sidecar:
+            if int(sidecar['size']) != size or int(sidecar['mtime_ns']) != mtime_ns:
+                return None
+            if version is not None and str(sidecar['version']) != version:
+                return None
+            index = pd.DatetimeIndex(sidecar['index'].astype('datetime64[ns]'), name='datetime')
+            columns = sidecar['columns']
+            # Two dimensional for the (channel, statistic) columns of aggregates
+            columns = pd.MultiIndex.from_arrays(list(columns.T)) if columns.ndim == 2 else list(columns)
+            return pd.DataFrame(sidecar['values'], index=index, columns=columns)
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def write_sidecar(sidecar_path, data, size, mtime_ns, version=None):
+    # Written to a temporary file first so that a concurrent reader never sees a partially written sidecar
+    try:
+        values = data.to_numpy(dtype=np.float64)
+    except (TypeError, ValueError):
+        return  # Only purely numeric data is cached
+    tmp_path = sidecar_path.with_name(f'{sidecar_path.stem}.{os.getpid()}.{threading.get_ident()}.tmp.npz')
+    extra = dict() if version is None else dict(version=version)
+    try:
+        sidecar_path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez(tmp_path,
+                 index=data.index.values.astype('datetime64[ns]').view(np.int64),
+                 values=values,
+                 columns=np.array(data.columns.tolist(), dtype=str),
+                 size=size,
+                 mtime_ns=mtime_ns,
+                 **extra)
+        os.replace(tmp_path, sidecar_path)
+    except OSError as e:
+        print(f'Warning, could not write cache file {sidecar_path}: {e}')
+
+
+def aggregate(data, resolution):
+    # Returns the min, max and mean of each column over buckets of width resolution, skipping empty buckets
+    if data.shape[0] == 0:
+        return pd.DataFrame()
+    return data.resample(resolution).agg(['min', 'max', 'mean']).dropna(how='all')
+
+
+def level_points(level):
+    """
+    Converts aggregates into a data frame with the same columns as the raw data holding two points per bucket, the
+    bucket minimum and maximum, both at the start time of the bucket. Plotting these instead of the raw data keeps
+    spikes visible.
+    """
+    if level.shape[0] == 0:
+        return pd.DataFrame()
+    mins = level.xs('min', axis=1, level=1)
+    maxs = level.xs('max', axis=1, level=1)
+    return pd.concat([mins, maxs]).sort_index(kind='stable')
+
+
+def concat_chunks(chunks):
+    # Concatenate a list of data frames with a single copy
+    chunks = [chunk for chunk in chunks if chunk.shape[0] > 0]
+    if not chunks:
+        return pd.DataFrame()
+    return pd.concat(chunks)
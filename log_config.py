@@ -0,0 +1,25 @@
+from pathlib import Path
+from conversion import LogDecadeConversion
+
+# Settings shared by log_script and webplot_script. This module must not import Qt or the instrument code so that
+# webplot_script and its worker processes run without PyQt5 and pyserial.
+log_drive = Path('Y:/', 'smalldata-e6', 'KeithleyLogger Data')
+backup_drive = Path('C:/', 'KeithleyLoggerBackup')
+error_drive = Path('C:/', 'KeithleyLoggerBackup,' 'Error')
+webplot_drive = Path('//oxford.physics.berkeley.edu/web/internal/e6/')
+
+
+def curr2press(curr):
+    # formula given in ion pump controller to convert current (expressed in nA) to pressure (in torr)
+    return 0.066 * curr * 10 ** -9 * 5600 / 7000 / 70
+
+
+# Plot settings of each group shared by the PlotWindows and the web plots of webplot_script. The functions used here
+# must be conversion specs or defined at module level so that the settings can be sent to other processes.
+plot_configs = {
+    'MagField': dict(ylabel='Magnetic Field', units_label='(mG)', plot_mode='multiplot'),
+    'IonGauge': dict(conv_func=LogDecadeConversion(), ylabel='Ion Gauge Pressure', units_label='(torr)', yscale='log'),
+    'IonPump': dict(conv_func=LogDecadeConversion(scale=1e9), ylabel='Ion Pump Current', units_label='(nA)',
+                    twinx_on=True, twinx_func=curr2press, twinx_label='Pressure (torr)'),
+    'LabTemp': dict(ylabel='Temperature', units_label=r'($^{\circ}C$)'),
+}
@@ -1,17 +1,44 @@
-from time import sleep
+from time import sleep, monotonic
 import datetime
+import inspect
+import threading
+import queue
 from pathlib import Path
-import csv
 import serial
+import numpy as np
 from PyQt5 import QtCore
 from loader import Loader
+from conversion import LinearConversion, BlockConversion, ConversionRegistry, raw_field
+from storage import CsvStorage, CsvWriter, read_csv_rows
 
 
 class Logger(QtCore.QObject):
     """
-    Configure data acquisition, process/organize data as it comes in, and control visualization of data
+    Configure data acquisition, process/organize data as it comes in, and control visualization of data.
+    device is a single device or a dict of devices by name for logging from several instruments. Each channel is
+    read by the device named by chan.device, which may be left as None if there is only one device, and all
+    channels of a SaveGroup must be read by the same device.
+    Communication with each device happens in its own AcquisitionWorker living in its own thread so that a slow or
+    hung instrument never blocks the GUI event loop or the other devices. All workers are triggered by the common
+    tick of a Ticker every log_freq seconds so the cycle time is that of the slowest device rather than the sum over
+    devices. Completed scans are delivered back to the Logger via Qt signals in blocks of one or more scans (more
+    than one when a device is operating in buffered mode).
+    timestamp_policy selects how scans are timestamped. With 'tick' the single scans of all devices from one tick
+    are merged into one scan stamped with the time of the tick, once every device has reported. With 'device' the
+    scans of each device are logged as soon as they arrive with the timestamps given by the device. Blocks of
+    several scans are always logged with the device timestamps.
+    Scans are converted by the conversion specs of the channels (see conversion.py) a whole block at a time.
+    Channels may be scanned only every chan.scan_every ticks of log_freq, readings of channels which were not scanned
+    are NaN and a SaveGroup only saves a row when at least one of its channels was scanned.
+    If a DataBus is given every converted scan is published on it per save group so that PlotWindows can plot recent
+    data from memory.
+    Devices must have blocking methods. Devices with coroutine methods such as asyncdevice.AsyncKeithley are
+    rejected, wrap them in an asyncdevice.SyncKeithley.
     """
-    def __init__(self, save_groups, device, log_freq, quiet=True):
+    scan_logged = QtCore.pyqtSignal(object)
+    timestamp_policies = ['tick', 'device']
+
+    def __init__(self, save_groups, device, log_freq, data_bus=None, timestamp_policy='tick', quiet=True):
         super(Logger, self).__init__()
         self.save_groups = save_groups
         self.channels = []
@@ -19,49 +46,246 @@ class Logger(QtCore.QObject):
             for channel in save_group.channels:
                 self.channels.append(channel)  # Add all of the channels in all of the save_groups into self.channels
 
-        self.device = device
-        self.device.init_measurement(self.channels)
-
+        self.devices = device if isinstance(device, dict) else {None: device}
+        if timestamp_policy not in self.timestamp_policies:
+            raise ValueError(f'Unknown timestamp policy {timestamp_policy}, must be one of {self.timestamp_policies}')
+        self.timestamp_policy = timestamp_policy
+        for device_name, curr_device in self.devices.items():
+            if inspect.iscoroutinefunction(getattr(curr_device, 'read_block', None)):
+                raise TypeError(f'Device {device_name} has coroutine methods, wrap it in an asyncdevice.SyncKeithley '
+                                f'to log from it')
+        # Global index in self.channels of the channels of each device, in the order of the device readout
+        self.device_columns = dict()
+        for device_name, curr_device in self.devices.items():
+            device_channels = [chan for chan in self.channels if self.device_name(chan) == device_name]
+            curr_device.init_measurement(device_channels, tick_interval=log_freq)
+            columns = np.empty(len(device_channels), dtype=np.intp)
+            for chan in device_channels:
+                columns[chan.chan_idx] = self.channels.index(chan)
+            self.device_columns[device_name] = columns
+        for save_group in self.save_groups:
+            if len({self.device_name(chan) for chan in save_group.channels}) > 1:
+                raise ValueError(f'The channels of SaveGroup {save_group.group_name} are read by more than one device')
+            group_device = self.devices[self.device_name(save_group.channels[0])]
+            scan_period = group_device.scan_interval if getattr(group_device, 'buffered', False) else log_freq
+            if scan_period < 1 and '%f' not in save_group.time_format:
+                print(f'Warning, SaveGroup {save_group.group_name} is scanned every {scan_period} s but its '
+                      f"time_format {save_group.time_format} only resolves whole seconds. Use '%H:%M:%S.%f'.")
+        self.converter = BlockConversion([chan.conv_func for chan in self.channels], range(len(self.channels)))
+
+        self.data_bus = data_bus
         self.quiet = quiet
 
         self.log_freq = log_freq
-        self.data_timer = QtCore.QTimer(self)
-        self.data_timer.timeout.connect(self.log_data)
-
-    def log_data(self):
-        curr_datetime, data = self.read_data()
-        data_str = ''
-        for chan in self.channels:
-            chan.curr_data = chan.conv_func(data[chan.chan_idx])  # Consider saving raw data instead of converted data
-            data_str += f'[{chan.chan_name}: {chan.curr_data:.3f}] '
+        self.pending_ticks = dict()  # Blocks received from each device for ticks which are not complete yet
+        self.acquisition_threads = []
+        self.acquisition_workers = []
+        self.tick_thread = QtCore.QThread()
+        self.ticker = Ticker(self.log_freq)
+        self.ticker.moveToThread(self.tick_thread)
+        self.tick_thread.started.connect(self.ticker.start)
+        for device_name, curr_device in self.devices.items():
+            acquisition_thread = QtCore.QThread()
+            acquisition_worker = AcquisitionWorker(curr_device, name=device_name, ticker=self.ticker,
+                                                   quiet=self.quiet)
+            acquisition_worker.moveToThread(acquisition_thread)
+            self.ticker.tick.connect(acquisition_worker.acquire)
+            acquisition_worker.block_ready.connect(self.receive_block)
+            self.acquisition_threads.append(acquisition_thread)
+            self.acquisition_workers.append(acquisition_worker)
+
+    def device_name(self, chan):
+        # Name of the device which reads chan
+        if chan.device is None and len(self.devices) == 1:
+            return next(iter(self.devices))
+        if chan.device not in self.devices:
+            raise ValueError(f'Channel {chan.chan_name} is assigned to unknown device {chan.device}')
+        return chan.device
+
+    @QtCore.pyqtSlot(object, int, object, object, object)
+    def receive_block(self, device_name, tick, tick_datetime, datetimes, scans):
+        if self.timestamp_policy == 'device' or len(scans) > 1:
+            if len(scans) > 0:
+                self.log_block(datetimes, self.place_scans(device_name, scans))
+            if self.timestamp_policy == 'device':
+                return
+            scans = []  # Already logged, the device only counts as having reported for the tick
+        pending = self.pending_ticks.setdefault(tick, (tick_datetime, dict()))
+        pending[1][device_name] = scans
+        if len(pending[1]) == len(self.devices):
+            # Log this tick along with any earlier ticks a device never reported for
+            for pending_tick in sorted(t for t in self.pending_ticks if t <= tick):
+                self.log_tick(*self.pending_ticks.pop(pending_tick))
+
+    def log_tick(self, tick_datetime, device_scans):
+        # Merge the single scans of the devices into one scan stamped with the time of the tick
+        scan = np.full(len(self.channels), np.nan)
+        for device_name, scans in device_scans.items():
+            if len(scans) > 0:
+                scan[self.device_columns[device_name]] = scans[0]
+        if not np.all(np.isnan(scan)):
+            self.log_block([tick_datetime], scan[np.newaxis, :])
+
+    def place_scans(self, device_name, scans):
+        # Spread the scans of one device over the columns of all channels, NaN for the channels of other devices
+        block = np.full((len(scans), len(self.channels)), np.nan)
+        block[:, self.device_columns[device_name]] = np.asarray(scans, dtype=np.float64)
+        return block
+
+    def log_block(self, datetimes, scans):
+        # scans holds one row per scan with the raw reading of each of self.channels
+        raw_block = np.asarray(scans, dtype=np.float64)
+        converted = self.converter(raw_block)
+        for curr_datetime, raw_data, values in zip(datetimes, raw_block, converted):
+            self.log_data(curr_datetime, raw_data, values)
+
+    def log_data(self, curr_datetime, raw_data, values):
+        # raw_data holds the raw reading and values the converted value of each of self.channels
+        for chan, raw_value, value in zip(self.channels, raw_data, values):
+            chan.raw_data = raw_value
+            chan.curr_data = value
         if not self.quiet:
-            print(data_str)
+            print(''.join(f'[{chan.chan_name}: {chan.curr_data:.3f}] ' for chan in self.channels))
         for save_group in self.save_groups:
+            if all(np.isnan(chan.raw_data) for chan in save_group.channels):
+                continue  # None of the channels of the group were scanned
             save_group.save_data(curr_datetime)
+            if self.data_bus is not None:
+                values = {chan.chan_name: chan.curr_data for chan in save_group.channels}
+                self.data_bus.publish(save_group.group_name, curr_datetime, values)
+        self.scan_logged.emit(curr_datetime)
+
+    def start_logging(self):
+        # The ticker triggers the workers immediately and then starts its own timer once its thread is running.
+        for acquisition_thread in self.acquisition_threads:
+            acquisition_thread.start()
+        self.tick_thread.start()
+
+    def stop_logging(self):
+        if self.tick_thread.isRunning():
+            QtCore.QMetaObject.invokeMethod(self.ticker, 'stop', QtCore.Qt.BlockingQueuedConnection)
+            self.tick_thread.quit()
+            self.tick_thread.wait()
+        for acquisition_thread in self.acquisition_threads:
+            acquisition_thread.quit()
+        for acquisition_thread in self.acquisition_threads:
+            acquisition_thread.wait()
+        for save_group in self.save_groups:
+            save_group.close()
+
+
+class Ticker(QtCore.QObject):
+    """
+    Common clock of all AcquisitionWorkers. Emits tick with the number and the datetime of the tick every log_freq
+    seconds from a dedicated QThread. latest_tick is the number of the most recent tick so that workers can tell
+    when a tick they are about to handle has already been superseded.
+    """
+    tick = QtCore.pyqtSignal(int, object)
+
+    def __init__(self, log_freq):
+        super(Ticker, self).__init__()
+        self.log_freq = log_freq
+        self.n_ticks = 0
+        self.latest_tick = -1
+        self.tick_timer = None
+
+    @QtCore.pyqtSlot()
+    def start(self):
+        # The timer is created here rather than in __init__ so that it belongs to the tick thread.
+        self.tick_timer = QtCore.QTimer()
+        self.tick_timer.timeout.connect(self.emit_tick)
+        self.emit_tick()  # Log data immediately before starting timer
+        self.tick_timer.start(int(self.log_freq*1e3))
+
+    @QtCore.pyqtSlot()
+    def stop(self):
+        if self.tick_timer is not None:
+            self.tick_timer.stop()
+
+    @QtCore.pyqtSlot()
+    def emit_tick(self):
+        self.latest_tick = self.n_ticks
+        self.tick.emit(self.n_ticks, datetime.datetime.now())
+        self.n_ticks += 1
+
+
+class AcquisitionWorker(QtCore.QObject):
+    """
+    Owns a device once logging has started and polls it from a dedicated QThread on every tick of the Ticker.
+    Completed scans are emitted through block_ready as (name, tick, tick datetime, datetimes, scans), where datetimes
+    and scans are two equal length lists with one entry per scan. Failed reads are reported and dropped so that the
+    GUI thread only ever sees complete scans, the lists are then empty so that the Logger knows the device has
+    reported for the tick.
+    Ticks which queued up while the device was busy, e.g. waiting for a timeout, are out of date once a newer tick
+    has been emitted. They are reported empty without reading the device, so that a slow device skips ticks rather
+    than reading them back to back and stamping the readings with the time of ticks long past.
+    """
+    block_ready = QtCore.pyqtSignal(object, int, object, object, object)
+
+    def __init__(self, device, name=None, ticker=None, quiet=True):
+        super(AcquisitionWorker, self).__init__()
+        self.device = device
+        self.name = name
+        self.ticker = ticker
+        self.quiet = quiet
+
+    @QtCore.pyqtSlot(int, object)
+    def acquire(self, tick, tick_datetime):
+        if self.ticker is not None and tick < self.ticker.latest_tick:
+            if not self.quiet:
+                print(f'{self.device_label()} skipped tick {tick}, a newer tick is already waiting')
+            self.block_ready.emit(self.name, tick, tick_datetime, [], [])
+            return
+        datetimes, scans = self.read_data()
+        self.block_ready.emit(self.name, tick, tick_datetime, datetimes, scans)
 
     def read_data(self):
-        curr_datetime = datetime.datetime.now()
-        data = self.device.read()
-        date_time_string = curr_datetime.strftime('%Y-%m-%d %H:%M:%S')
+        date_time_string = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         try:
-            if not self.quiet:
-                print(f'{date_time_string} raw data: ' + ', '.join([f"{datum:.3f}" for datum in data]))
-        except ValueError:
-            if data == ["b''"]:
-                print(date_time_string + ": Error: Received nothing from Keithley")
-            else:
-                print(date_time_string + f": Error: Received {data} from Keithley")
-        return curr_datetime, data
+            datetimes, scans = self.device.read_block()
+        except ValueError as e:
+            # Raised when the Keithley response can't be parsed, e.g. on a timeout where nothing is received.
+            print(date_time_string + f": Error: Could not parse data received from {self.device_label()}: {e}")
+            return [], []
+        except serial.SerialException as e:
+            print(date_time_string + f": Error: Serial communication with {self.device_label()} failed: {e}")
+            return [], []
+        if not self.quiet:
+            for curr_datetime, data in zip(datetimes, scans):
+                print(f'{curr_datetime.strftime("%Y-%m-%d %H:%M:%S")} {self.device_label()} raw data: '
+                      + ', '.join([f"{datum:.3f}" for datum in data]))
+        return datetimes, scans
 
-    def start_logging(self):
-        self.log_data()  # Log data immediately before starting timer
-        self.data_timer.start(self.log_freq*1e3)
+    def device_label(self):
+        return 'Keithley' if self.name is None else self.name
 
 
 class Keithley:
     """
     Handles serial communication with and initialization of the Keithley2700 multimeter
+
+    By default every call to read() triggers a single scan with READ?. If buffer_scans is set the Keithley is instead
+    configured to run buffer_scans scans on its own internal timer (one every scan_interval seconds), storing each
+    reading along with its timestamp in the internal trace buffer. read_block() then drains the whole buffer with a
+    single TRAC:DATA? query once it is full and re-arms the next buffered acquisition. With a scan_interval below one
+    second the SaveGroups need a time_format with sub-second resolution, e.g. '%H:%M:%S.%f', to keep the timestamps
+    apart.
+
+    data_format selects how readings are transferred. 'ASCII' is human readable. 'SREAL' (4 byte) and 'DREAL' (8 byte)
+    transfer IEEE754 floats which are decoded directly into a numpy array, roughly a third of the bytes on the wire for
+    SREAL. byte_order 'SWAP' is little-endian, 'NORM' is big-endian.
+
+    Channels are scanned on every chan.scan_every-th call of read_block() (tick), starting at tick chan.scan_phase.
+    Channels without a scan_phase are staggered so that slow channels fall on different ticks and the busiest tick
+    is as short as possible. The scan list is reprogrammed with ROUT:SCAN only when the set of channels due changes
+    from the previous tick, and the readings of channels which are not due are returned as NaN. line_frequency and
+    channel_overhead are used to estimate the time a scan takes from the NPLC of the channels, a warning is printed if
+    the scan schedule doesn't fit into the tick interval.
     """
+    binary_sizes = {'SREAL': 4, 'DREAL': 8}
+    max_buffer_points = 55000  # Capacity of the trace buffer in readings
+    # TRAC:FEED:CONT falls back to NEVER once the buffer has filled, it has to be set to NEXT again on every arm
+    arm_cmds = ["TRAC:CLE", "TRAC:FEED:CONT NEXT", "INIT"]
     preamble = ["*RST",
                 "SYST:PRES",
                 "SYST:BEEP OFF",
@@ -71,19 +295,49 @@ class Keithley:
                 "TRIG:COUN 1",
                 "FORM:ELEM READ"]
 
-    def __init__(self, port='COM0', baud_rate=9600, timeout=15, quiet=True):
+    def __init__(self, port='COM0', baud_rate=9600, timeout=15, buffer_scans=0, scan_interval=1.0,
+                 data_format='ASCII', byte_order='SWAP', line_frequency=60, channel_overhead=0.01, quiet=True):
         self.port = port
         self.baud_rate = baud_rate
         self.timeout = timeout
+        self.buffer_scans = buffer_scans
+        self.scan_interval = scan_interval
+        self.buffered = self.buffer_scans > 0
+        self.data_format = data_format.upper()
+        self.byte_order = byte_order.upper()
+        if self.data_format != 'ASCII' and self.data_format not in self.binary_sizes:
+            raise ValueError(f'Unsupported data format {data_format}, must be one of ASCII, SREAL or DREAL')
+        if self.byte_order not in ['SWAP', 'NORM']:
+            raise ValueError(f'Unsupported byte order {byte_order}, must be SWAP or NORM')
+        self.line_frequency = line_frequency
+        self.channel_overhead = channel_overhead
         self.quiet = quiet
 
+        self.channels = []
+        self.n_channels = 0
+        self.tick = 0
+        self.scan_phases = []  # Tick of the first scan of each channel, by chan_idx
+        self.scan_ports = None  # Hardware ports of the scan list currently programmed into the Keithley
+        self.buffer_points = 0
+        self.buffer_start = None
+
+        self.serial = None
+        self.connect()
+
+    def connect(self):
         self.serial = serial.Serial(self.port, self.baud_rate, timeout=self.timeout)
         print(f'Connected to device at {self.port}')
         for command in self.preamble:
             self.write(command)
             sleep(0.25)
+        if self.data_format != 'ASCII':
+            self.write(self.format_cmds())
+            sleep(0.25)
         self.serial.flushInput()
 
+    def format_cmds(self):
+        return [f"FORM:DATA {self.data_format}", f"FORM:BORD {self.byte_order}"]
+
     def write(self, command):
         # Write a single string or a list of strings to the device
         if isinstance(command, list):
@@ -95,14 +349,109 @@ class Keithley:
             self.serial.write(f'{command}\n'.encode())
             # Manually insert EOL character for communication and convert to binary for writing with encode()
 
+    def query(self, command):
+        # Write a single command and return the decoded response up to the termination character
+        self.write(command)
+        return self.serial.read_until(b"\r").decode().strip()
+
     def read(self):
-        # Read data from Keithley and return list of floats representing recorded values
-        self.write("READ?")
-        data = self.serial.read_until(b"\r").decode().split(',')
-        data = list(map(float, data))
-        return data
+        """
+        Scan the channels which are due on this tick and return a numpy array with one value per channel, NaN for
+        channels which were not scanned.
+        """
+        due = self.due_channels()
+        scan = np.full(self.n_channels, np.nan)
+        if not due:
+            return scan
+        self.set_scan_list([chan.hard_port for chan in due])
+        scan[[chan.chan_idx for chan in due]] = self.query_values("READ?", len(due))
+        return scan
+
+    def due_channels(self):
+        # Channels to be scanned on the current tick, advances to the next tick
+        due = [chan for chan in self.channels
+               if (self.tick - self.scan_phases[chan.chan_idx]) % chan.scan_every == 0]
+        self.tick += 1
+        return due
+
+    def set_scan_list(self, hard_ports):
+        self.write(self.scan_list_cmds(hard_ports))
+
+    def scan_list_cmds(self, hard_ports):
+        # Commands to reprogram the scan list, none if it is the scan list programmed last
+        if hard_ports == self.scan_ports:
+            return []
+        self.scan_ports = hard_ports
+        chan_list_str = '(@' + ','.join([str(hard_port) for hard_port in hard_ports]) + ')'
+        return [f"ROUT:SCAN {chan_list_str}",
+                f"SAMP:COUN {len(hard_ports)}",
+                "ROUT:SCAN:LSEL INT"]
+
+    def query_values(self, command, n_values):
+        """
+        Write a data query and return the readings. ASCII responses are parsed into a list of floats. Binary responses
+        consist of the #0 block header followed by n_values floats and the termination character and are returned as
+        a numpy float64 array.
+        """
+        if self.data_format == 'ASCII':
+            return self.parse_ascii(self.query(command))
+        self.write(command)
+        n_bytes = n_values * self.binary_sizes[self.data_format]
+        header = self.serial.read(2)
+        payload = self.serial.read(n_bytes)
+        self.serial.read_until(b"\r")
+        if header != b'#0' or len(payload) != n_bytes:
+            raise ValueError(f'expected {n_bytes} bytes of {self.data_format} data, received {header + payload}')
+        return self.parse_binary(payload)
+
+    def parse_binary(self, payload):
+        endian = '<' if self.byte_order == 'SWAP' else '>'
+        dtype = np.dtype(f'{endian}f{self.binary_sizes[self.data_format]}')
+        return np.frombuffer(payload, dtype=dtype).astype(np.float64)
+
+    def read_block(self):
+        """
+        Return (datetimes, scans) for all scans which have completed since the last call. In unbuffered mode this
+        is a single scan triggered by READ?. In buffered mode the trace buffer is only drained once it is full,
+        otherwise two empty lists are returned and the buffer is left to continue filling.
+        """
+        if not self.buffered:
+            curr_datetime = datetime.datetime.now()
+            return [curr_datetime], [self.read()]
+
+        points_stored = int(self.query("TRAC:POIN:ACT?"))
+        if points_stored < self.buffer_points:
+            return [], []
+        data = self.query_values("TRAC:DATA?", 2 * self.buffer_points)
+        buffer_start = self.buffer_start
+        self.arm_buffer()
+        return self.parse_buffer(data, buffer_start)
+
+    def parse_buffer(self, data, buffer_start):
+        # With FORM:ELEM READ,TST each reading is followed by its timestamp relative to the first reading in the
+        # buffer. The timestamp of the first reading in a scan is used as the timestamp for the whole scan.
+        data = data[:2 * self.buffer_points]
+        readings = data[0::2]
+        timestamps = data[1::2]
+        datetimes = []
+        scans = []
+        for scan_idx in range(len(readings) // self.n_channels):
+            first = scan_idx * self.n_channels
+            datetimes.append(buffer_start + datetime.timedelta(seconds=timestamps[first]))
+            scans.append(readings[first:first + self.n_channels])
+        return datetimes, scans
+
+    def arm_buffer(self):
+        # Clear the trace buffer and start the next buffered acquisition
+        self.write(self.arm_cmds)
+        self.buffer_start = datetime.datetime.now()
+
+    @staticmethod
+    def parse_ascii(data):
+        # Convert a comma separated ASCII response into floats. Unit suffixes such as VDC or SECS are removed.
+        return [float(datum.strip().rstrip('ABCDEFGHIJKLMNOPQRSTUVWXYZ#')) for datum in data.split(',')]
 
-    def init_measurement(self, channels):
+    def init_measurement(self, channels, tick_interval=None):
         """
         The main purpose of this method is to initialize the Keithley to scan the appropriate hardware ports
         specified in chan.hard_port for each channel in input parameter channels. This is done by the 3 self.write()
@@ -112,69 +461,182 @@ class Keithley:
         is saved in the channel.chan_idx attribute for each channel.
         This enumeration will be recalled when the Logger object parses the data from the Keithley readout in the
         Logger.log_data() method.
+        If tick_interval, the time in seconds between calls of read_block(), is given the scan schedule is checked
+        against it.
         """
+        for command in self.measurement_cmds(channels):
+            self.write(command)
+        if self.buffered:
+            self.init_buffer()
+        if tick_interval is not None:
+            self.check_schedule(tick_interval)
+
+    def measurement_cmds(self, channels):
+        # Assigns chan_idx to channels and returns the commands to initialize them and the scan list
+        if self.buffered and any(chan.scan_every != 1 for chan in channels):
+            raise ValueError('Channels with scan_every other than 1 are not supported in buffered mode')
+        commands = []
         for idx, chan in enumerate(channels):
             chan.chan_idx = idx
-            self.write(chan.init_cmds)
+            commands.extend(chan.init_cmds)
             print(f'Initialized logical channel {chan.chan_idx:d}: {chan.chan_name} '
                   f'at Keithley port ({chan.hard_port:d})')
-        chan_list_str = '(@' + ','.join([str(chan.hard_port) for chan in channels]) + ')'
-        self.write(f"ROUT:SCAN {chan_list_str}")
-        self.write(f"SAMP:COUN {len(channels)}")
-        self.write("ROUT:SCAN:LSEL INT")
+        self.channels = list(channels)
+        self.n_channels = len(channels)
+        self.tick = 0
+        self.scan_phases = self.schedule_phases(self.channels)
+        self.scan_ports = None
+        commands.extend(self.scan_list_cmds([chan.hard_port for chan in channels]))
+        return commands
+
+    def scan_time(self, channels):
+        # Estimated time in seconds to scan channels, from the integration time of each channel and a fixed overhead
+        return sum(chan.nplc / self.line_frequency + self.channel_overhead for chan in channels)
+
+    def schedule_phases(self, channels):
+        """
+        Returns the scan phase of each of channels. Channels with a scan_phase keep it, the others are placed one at a
+        time, slowest first, on the phase whose busiest tick is the least busy so far.
+        """
+        ticks = self.schedule_ticks(channels)
+        load = np.zeros(ticks)
+        phases = [None] * len(channels)
+        for n, chan in enumerate(channels):
+            if chan.scan_every == 1 or chan.scan_phase is not None:
+                phases[n] = 0 if chan.scan_phase is None else chan.scan_phase % chan.scan_every
+                load[phases[n]::chan.scan_every] += self.scan_time([chan])
+        auto = [n for n in range(len(channels)) if phases[n] is None]
+        for n in sorted(auto, key=lambda n: -self.scan_time([channels[n]])):
+            chan = channels[n]
+            phases[n] = min(range(chan.scan_every), key=lambda phase: load[phase::chan.scan_every].max())
+            load[phases[n]::chan.scan_every] += self.scan_time([chan])
+        return phases
 
     @staticmethod
-    def volt_cmds(hard_port):
+    def schedule_ticks(channels):
+        # Number of ticks after which the scan schedule repeats
+        return int(np.lcm.reduce([chan.scan_every for chan in channels])) if channels else 1
+
+    def tick_scan_times(self):
+        # Estimated scan time of each tick over one period of the scan schedule
+        times = np.zeros(self.schedule_ticks(self.channels))
+        for chan, phase in zip(self.channels, self.scan_phases):
+            times[phase::chan.scan_every] += self.scan_time([chan])
+        return times
+
+    def check_schedule(self, tick_interval):
+        """
+        Warn if the scan on the busiest tick of the scan schedule takes longer than tick_interval. Returns the
+        estimated scan time of the busiest tick and the average scan time per tick.
+        """
+        times = self.tick_scan_times()
+        max_scan_time = float(times.max())
+        mean_scan_time = float(times.mean())
+        if max_scan_time > tick_interval:
+            print(f'Warning, the busiest tick of the scan schedule takes an estimated {max_scan_time:.3f} s which is '
+                  f'longer than the tick interval of {tick_interval} s. Reduce the NPLC or scan slow channels less '
+                  f'often.')
+        if not self.quiet:
+            print(f'Estimated scan time {max_scan_time:.3f} s on the busiest tick, {mean_scan_time:.3f} s on average')
+        return max_scan_time, mean_scan_time
+
+    def init_buffer(self):
+        """
+        Configure the trace buffer to hold buffer_scans complete scans. The trigger layer is switched to the internal
+        timer so that the Keithley paces the scans itself, and each reading is stored with its timestamp.
+        """
+        self.write(self.buffer_cmds())
+        print(f'Initialized trace buffer for {self.buffer_scans:d} scans every {self.scan_interval} s')
+        self.arm_buffer()
+
+    def buffer_cmds(self):
+        self.buffer_points = self.buffer_scans * self.n_channels
+        if self.buffer_points > self.max_buffer_points:
+            raise ValueError(f'{self.buffer_scans} scans of {self.n_channels} channels exceed the trace buffer of '
+                             f'{self.max_buffer_points} readings')
+        return ["TRAC:CLE",
+                f"TRAC:POIN {self.buffer_points}",
+                "TRAC:FEED SENS",
+                "TRAC:FEED:CONT NEXT",
+                "TRAC:TST:FORM ABS",
+                "FORM:ELEM READ,TST",
+                "TRIG:SOUR TIM",
+                f"TRIG:TIM {self.scan_interval}",
+                f"TRIG:COUN {self.buffer_scans}"]
+
+    @staticmethod
+    def volt_cmds(hard_port, nplc=5):
         return [f"SENS:FUNC 'VOLT',(@{hard_port})",
-                f"SENS:VOLT:NPLC 5,(@{hard_port})",
+                f"SENS:VOLT:NPLC {nplc},(@{hard_port})",
                 f"SENS:VOLT:RANG 5,(@{hard_port})"]
 
     @staticmethod
-    def rtd_cmds(hard_port):
+    def rtd_cmds(hard_port, nplc=5):
         return [f"SENS:FUNC 'TEMP',(@{hard_port})",
                 f"SENS:TEMP:TRAN FRTD,(@{hard_port})",
                 f"SENS:TEMP:FRTD:TYPE PT100,(@{hard_port})",
-                f"SENS:TEMP:NPLC 5,(@{hard_port})"]
+                f"SENS:TEMP:NPLC {nplc},(@{hard_port})"]
 
     @staticmethod
-    def thrmstr_cmds(hard_port):
+    def thrmstr_cmds(hard_port, nplc=5):
         return [f"SENS:FUNC 'TEMP',(@{hard_port})",
                 f"SENS:TEMP:TRAN THER,(@{hard_port})",
                 f"SENS:TEMP:THER:TYPE 10000,(@{hard_port})",
-                f"SENS:TEMP:NPLC 5,(@{hard_port})"]
+                f"SENS:TEMP:NPLC {nplc},(@{hard_port})"]
 
     @staticmethod
-    def thcpl_cmds(hard_port):
+    def thcpl_cmds(hard_port, nplc=5):
         return [f"SENS:FUNC 'TEMP',(@{hard_port})",
                 f"SENS:TEMP:TRAN TC,(@{hard_port})",
                 f"SENS:TEMP:TC:TYPE K,(@{hard_port})",
                 # f"SENS:TEMP:TC:RJUN:RSEL INT,(@{hard_port})",
                 f"SENS:TEMP:TC:RJUN:RSEL SIM,(@{hard_port})",
                 f"SENS:TEMP:TC:RJUN:SIM 23,(@{hard_port})",
-                f"SENS:TEMP:NPLC 5,(@{hard_port})"]
+                f"SENS:TEMP:NPLC {nplc},(@{hard_port})"]
 
 
 class Channel:
     """
-    Single data channel
+    Single data channel. conv_func converts the raw readings of the channel, preferably one of the conversion specs
+    LinearConversion, LogDecadeConversion or UfuncConversion. Plain functions must work on numpy arrays.
+    The channel is scanned every scan_every ticks of the Logger with an integration time of nplc power line cycles,
+    first on tick scan_phase. If scan_phase is None the device chooses it to spread slow channels over the ticks.
+    device is the name of the device reading the channel when the Logger is given several devices.
     """
     def __init__(self, hard_port=101, chan_idx=0, chan_name="Voltage",
-                 conv_func=lambda x: x, init_cmds_template=Keithley.volt_cmds):
+                 conv_func=LinearConversion(), init_cmds_template=Keithley.volt_cmds, scan_every=1, nplc=5,
+                 scan_phase=None, device=None):
         self.hard_port = hard_port
         self.chan_idx = chan_idx  # chan_idx will be configured by the Logger and Keithley objects upon initialization
         self.chan_name = chan_name
         self.conv_func = conv_func
-        self.init_cmds = init_cmds_template(hard_port)
+        self.scan_every = scan_every
+        self.scan_phase = scan_phase
+        self.nplc = nplc
+        self.device = device
+        self.init_cmds = init_cmds_template(hard_port, nplc=nplc)
+        self.raw_data = 0
         self.curr_data = 0
 
 
 class SaveGroup:
     """
     Collection of channels whose data will be saved in a common file.
+    Rows are handed to one WriterThread per destination (log and backup drive) so that a slow network drive never
+    delays acquisition or the writes to the other drive. Rows which can't be written to the log drive are spooled to
+    the error drive and replayed into the log drive once it is reachable again.
+    storage selects the file format on the log drive, e.g. storage.HDF5Storage for fast loading of long histories.
+    The backup drive is always written in the .csv format which doubles as a human readable export.
+    With save_raw the raw reading of every channel is saved alongside its converted value in a '{chan_name} raw'
+    column and the conversions of the channels are recorded in a ConversionRegistry, so that the Loader can recompute
+    the converted values if a conversion is corrected later. The registry is kept on the backup drive, which is
+    local, and synced to the log drive by the log writer after its first successful write, so that an unreachable
+    log drive neither stops the Logger from starting nor loses conversions.
     """
     def __init__(self, channels, group_name='DataGroup',
                  log_drive=None, backup_drive=None, error_drive=None, webplot_drive=None,
-                 date_format='%Y-%m-%d', time_format='%H:%M:%S', quiet=True):
+                 date_format='%Y-%m-%d', time_format='%H:%M:%S', storage=None,
+                 max_queue=10000, batch_size=100, flush_interval=2.0, save_raw=False, quiet=True):
         self.channels = channels
         if not isinstance(self.channels, list):
             self.channels = [self.channels]
@@ -185,67 +647,285 @@ class SaveGroup:
         self.webplot_drive = webplot_drive
         self.date_format = date_format
         self.time_format = time_format
+        self.backup_storage = CsvStorage(date_format=self.date_format, time_format=self.time_format)
+        self.storage = storage
+        if self.storage is None:
+            self.storage = self.backup_storage
+        self.save_raw = save_raw
         self.quiet = quiet
 
+        self.conversions = None
+        self.conversions_synced = True
+        if self.save_raw:
+            registry_name = f'{self.group_name} conversions.json'
+            registry_drive = self.backup_drive if self.backup_drive is not None else self.log_drive
+            self.conversions = ConversionRegistry(Path(registry_drive, registry_name))
+            now = datetime.datetime.now()
+            changed = [self.conversions.ensure(chan.chan_name, chan.conv_func, now) for chan in self.channels]
+            if any(changed):
+                try:
+                    self.conversions.save()
+                except OSError as e:
+                    print(f'Warning, could not save conversions to {self.conversions.file_path}: {e}')
+            self.conversions_synced = registry_drive == self.log_drive
+
+        writer_kwargs = dict(max_queue=max_queue, batch_size=batch_size, flush_interval=flush_interval, quiet=quiet)
+        self.spool = None
+        if self.error_drive is not None:
+            self.spool = Spool(self.error_drive, self.log_drive, self.group_name, storage=self.storage,
+                               quiet=self.quiet)
+        self.log_writer = WriterThread(f'{self.group_name} log', writer=self.storage.make_writer(quiet=self.quiet),
+                                       fallback=self.log_write_failed, spool=self.spool,
+                                       on_written=self.sync_conversions, **writer_kwargs)
+        self.backup_writer = WriterThread(f'{self.group_name} backup', fallback=self.backup_write_failed,
+                                          **writer_kwargs)
+
     def save_data(self, datetime_stamp):
-        data_dict = dict()
-        data_dict['date'] = datetime_stamp.strftime(self.date_format)
-        data_dict['time'] = datetime_stamp.strftime(self.time_format)
-        # Legacy format for saving the data. Would make sense to save datetime string in one cell.
+        values = dict()
         for chan in self.channels:
-            data_dict[chan.chan_name] = f'{chan.curr_data:f}'
+            values[chan.chan_name] = chan.curr_data
+        if self.save_raw:
+            for chan in self.channels:
+                values[raw_field(chan.chan_name)] = chan.raw_data
+
+        log_file_path = Path(self.log_drive, self.storage.file_name(self.group_name, datetime_stamp))
+        self.log_writer.submit(log_file_path, self.storage.make_row(datetime_stamp, values))
+        backup_file_path = Path(self.backup_drive, self.backup_storage.file_name(self.group_name, datetime_stamp))
+        self.backup_writer.submit(backup_file_path, self.backup_storage.make_row(datetime_stamp, values))
+
+    def sync_conversions(self):
+        # Runs in the log writer thread after rows were written, so the log drive is reachable
+        if self.conversions_synced:
+            return
+        file_path = Path(self.log_drive, self.conversions.file_path.name)
+        try:
+            self.conversions.sync(file_path)
+        except (OSError, ValueError) as e:
+            print(f'Warning, {type(e).__name__} while attempting to sync conversions to {file_path}: {e}')
+            return
+        self.conversions_synced = True
+
+    @staticmethod
+    def log_write_failed(file_path, rows):
+        print(f'Warning, could not write or spool {len(rows)} rows for log file: {file_path}')
 
-        log_file_name = f'{self.group_name} {data_dict["date"]}.csv'
-        log_file_path = Path(self.log_drive, log_file_name)
+    @staticmethod
+    def backup_write_failed(file_path, rows):
+        print(f'Warning, could not write {len(rows)} rows to backup log: {file_path}')
+        # print('Ok, even backup log directory is having trouble. Shit has gone to hell! Abandon ship!')
+
+    def writer_stats(self):
+        stats = {'log': self.log_writer.stats(),
+                 'backup': self.backup_writer.stats()}
+        if self.spool is not None:
+            stats['log']['spool_files'] = len(self.spool.pending)
+        return stats
+
+    def close(self):
+        self.log_writer.close()
+        self.backup_writer.close()
+        if self.spool is not None:
+            self.spool.close()
+
+    def make_loader(self, quiet=None, cache_drive=None):
+        # By default parsed days are cached on the (local) backup drive
+        if quiet is None:
+            quiet = self.quiet
+        if cache_drive is None and self.backup_drive is not None:
+            cache_drive = Path(self.backup_drive, 'Cache')
+        return Loader(self.log_drive, self.group_name, date_format=self.date_format, time_format=self.time_format,
+                      storage=self.storage, cache_drive=cache_drive, conversions=self.conversions, quiet=quiet)
 
-        # Attempt to write data to log_drive. Write to error_drive in event of failure.
+
+class WriterThread(threading.Thread):
+    """
+    Background writer for a single destination. Rows are submitted to a bounded queue without blocking the caller
+    and are written by writer (a CsvWriter by default) in batches, flushing once batch_size rows are pending or
+    flush_interval seconds after the first pending row arrived, whichever comes first. Rows which fail to write, or
+    which are rejected because the queue is full, are appended to the spool if one is given. While the spool holds
+    rows all new rows join them there, and once the queue has drained they are replayed together in timestamp order
+    so that the files on the destination stay sorted by time. Rows which can't be spooled are passed to
+    fallback(file_path, rows). on_written() is called in the writer thread after each flush which wrote rows.
+    stats() reports queue depth and throughput so that back-pressure on a destination can be monitored.
+    """
+    stop_token = object()
+
+    def __init__(self, name, writer=None, max_queue=10000, batch_size=100, flush_interval=2.0, fallback=None,
+                 spool=None, on_written=None, quiet=True):
+        super(WriterThread, self).__init__(name=name, daemon=True)
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fallback = fallback
+        self.spool = spool
+        self.on_written = on_written
+        self.quiet = quiet
+        self.writer = writer
+        if self.writer is None:
+            self.writer = CsvWriter(quiet=quiet)
+
+        self.rows_written = 0
+        self.rows_failed = 0
+        self.rows_rejected = 0
+        self.max_queue_depth = 0
+        self.flush_count = 0
+        self.last_flush_duration = 0.0
+        self.start()
+
+    def submit(self, file_path, data_dict):
+        # Queue a row for writing. Returns False if the queue is full in which case the row is spilled.
         try:
-            write_to_csv(log_file_path, data_dict, quiet=self.quiet)
-        except OSError:
-            print(f'Warning, OSError while attempting to write data to log file: {log_file_path}')
-            error_file_name = f'Error - {log_file_name}'
-            error_file_path = Path(self.error_drive, error_file_name)
+            self.queue.put_nowait((file_path, data_dict))
+        except queue.Full:
+            self.rows_rejected += 1
+            self.spill(file_path, [data_dict])
+            return False
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return True
+
+    def run(self):
+        pending = []
+        deadline = None
+        while True:
+            if pending:
+                timeout = max(0.0, deadline - monotonic())
+            else:
+                timeout = None
             try:
-                write_to_csv(error_file_path, data_dict, quiet=self.quiet)
-            except OSError:
-                print(f'Warning, OSError while attempting to write data to error log: {error_file_path}')
-
-        backup_file_name = log_file_name
-        backup_file_path = Path(self.backup_drive, backup_file_name)
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is self.stop_token:
+                self.flush(pending)
+                self.writer.close()
+                return
+            if item is not None:
+                pending.append(item)
+                if len(pending) == 1:
+                    deadline = monotonic() + self.flush_interval
+            if item is None or len(pending) >= self.batch_size:
+                self.flush(pending)
+                pending = []
+
+    def flush(self, pending):
+        # Write pending rows, grouping consecutive rows destined for the same file into a single write.
+        t0 = monotonic()
+        rows_written = self.rows_written
+        idx = 0
+        while idx < len(pending):
+            file_path = pending[idx][0]
+            rows = []
+            while idx < len(pending) and pending[idx][0] == file_path:
+                rows.append(pending[idx][1])
+                idx += 1
+            if self.spool is not None and self.spool.pending:
+                # Writing these rows now would put them ahead of older spooled rows, they are replayed with them
+                self.spill(file_path, rows)
+                continue
+            try:
+                self.writer.write_rows(file_path, rows)
+                self.rows_written += len(rows)
+            except (OSError, ValueError) as e:
+                print(f'Warning, {type(e).__name__} while attempting to write to {file_path}: {e}')
+                self.rows_failed += len(rows)
+                self.spill(file_path, rows)
+        if self.spool is not None and self.spool.pending and self.queue.empty():
+            # Bring the destination up to date with the spooled rows once no older rows are waiting in the queue
+            try:
+                self.rows_written += self.spool.replay(self.writer)
+            except (OSError, ValueError) as e:
+                print(f'Warning, {type(e).__name__} while attempting to replay spooled rows: {e}')
+        if self.on_written is not None and self.rows_written > rows_written:
+            self.on_written()
+        self.flush_count += 1
+        self.last_flush_duration = monotonic() - t0
+
+    def spill(self, file_path, rows):
+        if self.spool is not None:
+            try:
+                self.spool.append(file_path, rows)
+                return
+            except (OSError, ValueError) as e:
+                print(f'Warning, {type(e).__name__} while attempting to spool rows for {file_path}: {e}')
+        if self.fallback is not None:
+            self.fallback(file_path, rows)
+
+    def stats(self):
+        return {'queue_depth': self.queue.qsize(),
+                'max_queue_depth': self.max_queue_depth,
+                'rows_written': self.rows_written,
+                'rows_failed': self.rows_failed,
+                'rows_rejected': self.rows_rejected,
+                'flush_count': self.flush_count,
+                'last_flush_duration': self.last_flush_duration}
+
+    def close(self, timeout=None):
+        # Write out all rows queued before the call to close and stop the thread.
         try:
-            write_to_csv(backup_file_path, data_dict, quiet=self.quiet)
-        except OSError:
-            print(f'Warning, OSError while attempting to write to backup log: {backup_file_path}')
-            # print('Ok, even backup log directory is having trouble. Shit has gone to hell! Abandon ship!')
+            self.queue.put(self.stop_token, timeout=timeout)
+        except queue.Full:
+            print(f'Warning, could not stop writer {self.name}, queue is full')
+            return
+        self.join(timeout)
 
-    def make_loader(self, quiet=None):
-        if quiet is None:
-            quiet = self.quiet
-        return Loader(self.log_drive, self.group_name, quiet=quiet)
-
-
-def write_to_csv(file_path, data_dict, quiet=True):
-    keys = data_dict.keys()
-    file_exists = Path.is_file(file_path)
-    if file_exists:
-        fieldnames = get_csv_header(file_path)
-        if set(fieldnames) != set(keys):
-            raise ValueError(f'keys {keys} in data input do not match header {fieldnames} for {file_path}')
-    else:
-        fieldnames = keys
-    file_path.parent.mkdir(exist_ok=True)
-    with file_path.open('a') as file:
-        writer = csv.DictWriter(file, fieldnames=fieldnames)
-        if not file_exists:
-            writer.writeheader()
-        writer.writerow(data_dict)
-        if not quiet:
-            print(f'wrote {data_dict} to {file_path}')
-
-
-def get_csv_header(file_path):
-    # Returns the first line of a .csv file to be interpreted as the header.
-    with open(file_path, 'r') as file:
-        reader = csv.reader(file)
-        header = next(reader)
-    return header
+
+class Spool:
+    """
+    Durable local store for rows which could not be written to the log drive. Rows are appended to
+    'Error - <log file name>.csv' in spool_drive and synced to disk, whatever the storage format of the log drive.
+    replay() copies the spooled rows sorted by timestamp into the original log files in target_drive, skipping rows
+    which are already present there, and then deletes the spool file. Spool files left over from previous runs
+    are picked up at initialization.
+    """
+    prefix = 'Error - '
+
+    def __init__(self, spool_drive, target_drive, file_prefix, storage=None, quiet=True):
+        self.spool_drive = spool_drive
+        self.target_drive = target_drive
+        self.file_prefix = file_prefix
+        self.storage = storage
+        if self.storage is None:
+            self.storage = CsvStorage()
+        self.quiet = quiet
+        self.lock = threading.Lock()
+        self.writer = CsvWriter(fsync=True, quiet=quiet)
+        self.pending = set(Path(self.spool_drive).glob(f'{self.prefix}{self.file_prefix} *.csv'))
+        if self.pending:
+            print(f'Found {len(self.pending)} spool files to replay for {self.file_prefix}')
+
+    def append(self, file_path, rows):
+        spool_path = Path(self.spool_drive, f'{self.prefix}{file_path.stem}.csv')
+        with self.lock:
+            self.writer.write_rows(spool_path, rows)
+            self.pending.add(spool_path)
+        if not self.quiet:
+            print(f'spooled {len(rows)} rows to {spool_path}')
+
+    def replay(self, writer):
+        # Returns the number of rows written
+        n_replayed = 0
+        with self.lock:
+            self.writer.close()  # Release the spool file so that it can be removed
+            for spool_path in sorted(self.pending):
+                target_name = f'{spool_path.stem[len(self.prefix):]}.{self.storage.extension}'
+                target_path = Path(self.target_drive, target_name)
+                written = self.storage.read_keys(target_path)
+                rows = []
+                for data_dict in read_csv_rows(spool_path):
+                    row_key = self.storage.row_key(data_dict)
+                    if written[row_key] > 0:
+                        written[row_key] -= 1  # Written before an earlier replay was interrupted
+                    else:
+                        rows.append(data_dict)
+                rows.sort(key=self.storage.row_time)  # Rows rejected by a full queue may be out of order
+                if rows:
+                    writer.write_rows(target_path, rows)
+                    n_replayed += len(rows)
+                spool_path.unlink()
+                self.pending.discard(spool_path)
+                print(f'Replayed {len(rows)} spooled rows from {spool_path} into {target_path}')
+        return n_replayed
+
+    def close(self):
+        with self.lock:
+            self.writer.close()
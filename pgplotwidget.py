@@ -0,0 +1,117 @@
+import numpy as np
+import pyqtgraph as pg
+from PyQt5 import QtWidgets
+
+
+class PgPlotWidget(QtWidgets.QWidget):
+    """
+    pyqtgraph alternative to PlotWidget, implementing the same configure_plot()/update_plot()/n_pixels() interface
+    used by PlotWindow. Curves are clipped to the visible range and peak downsampled by pyqtgraph itself, which makes
+    redraws of long, densely sampled histories much cheaper than with matplotlib.
+    Timestamps are passed to pyqtgraph as seconds since 1970-01-01 of the naive local datetimes and the date axes are
+    configured with utcOffset=0 so that they display the same local times as the .csv files.
+    """
+    def __init__(self, *args, **kwargs):
+        QtWidgets.QWidget.__init__(self, *args, **kwargs)
+        self.setLayout(QtWidgets.QVBoxLayout())
+        self.graphics = pg.GraphicsLayoutWidget()
+        self.graphics.setBackground('w')
+        self.layout().addWidget(self.graphics)
+        self.plot_items = []
+        self.twin_axes = []
+        self.curves = dict()
+        self.log_y = False
+
+    def configure_plot(self, plot_mode, data_fields, ylabel='Signal Level', units_label='(a.u.)', yscale='linear',
+                       twinx_on=False, twinx_label='Signal Level'):
+        self.graphics.clear()
+        self.plot_items = []
+        self.twin_axes = []
+        self.curves = dict()
+        self.log_y = yscale == 'log'
+        if plot_mode == 'singleplot':
+            n_axes = 1
+        elif plot_mode == 'multiplot':
+            n_axes = len(data_fields)
+        else:
+            raise ValueError(f'Unknown plot mode {plot_mode}')
+        for n in range(n_axes):
+            axis_items = {'bottom': pg.DateAxisItem(orientation='bottom', utcOffset=0)}
+            if twinx_on:
+                twin_axis = TwinAxisItem(orientation='right')
+                axis_items['right'] = twin_axis
+                self.twin_axes.append(twin_axis)
+            plot_item = self.graphics.addPlot(row=n, col=0, axisItems=axis_items)
+            if self.plot_items:
+                plot_item.setXLink(self.plot_items[0])
+            plot_item.setLogMode(y=self.log_y)
+            plot_item.setClipToView(True)
+            plot_item.setDownsampling(auto=True, mode='peak')
+            plot_item.setLabel('bottom', 'Time')
+            if twinx_on:
+                plot_item.showAxis('right')
+                plot_item.setLabel('right', twinx_label)
+            self.plot_items.append(plot_item)
+        if plot_mode == 'singleplot':
+            self.plot_items[0].setLabel('left', f'{ylabel} {units_label}')
+            self.plot_items[0].addLegend()
+        for n, field in enumerate(data_fields):
+            plot_item = self.plot_items[0] if plot_mode == 'singleplot' else self.plot_items[n]
+            color = pg.intColor(n, hues=max(len(data_fields), 1))
+            self.curves[field] = plot_item.plot([], [], pen=None, symbol='o', symbolSize=4, symbolPen=None,
+                                                symbolBrush=color, name=field)
+            if plot_mode == 'multiplot':
+                plot_item.setLabel('left', f'{field} {units_label}')
+
+    def update_plot(self, plot_data, start_datetime, stop_datetime, ylim=None, twinx_func=(lambda x: x)):
+        # Same arguments as PlotRenderer.update
+        for field, curve in self.curves.items():
+            field_data = plot_data.get(field)
+            if field_data is None or len(field_data) == 0:
+                curve.setData([], [])
+            else:
+                curve.setData(index_to_seconds(field_data.index), field_data.to_numpy(dtype=np.float64))
+        x_start = index_to_seconds([np.datetime64(start_datetime)])[0]
+        x_stop = index_to_seconds([np.datetime64(stop_datetime)])[0]
+        for plot_item in self.plot_items:
+            plot_item.setXRange(x_start, x_stop, padding=0)
+            if ylim is None:
+                plot_item.enableAutoRange(axis='y')
+            else:
+                ymin, ymax = ylim
+                if self.log_y:
+                    # View coordinates are log10 of the data in log mode
+                    ymin, ymax = np.log10(ymin), np.log10(ymax)
+                plot_item.setYRange(ymin, ymax, padding=0)
+        for twin_axis in self.twin_axes:
+            twin_axis.set_func(twinx_func, self.log_y)
+
+    def n_pixels(self):
+        return self.graphics.width()
+
+
+class TwinAxisItem(pg.AxisItem):
+    """
+    Secondary y axis labelling the ticks of the main y axis with func applied, equivalent to the matplotlib twin axis.
+    """
+    def __init__(self, *args, **kwargs):
+        pg.AxisItem.__init__(self, *args, **kwargs)
+        self.func = (lambda x: x)
+        self.log_y = False
+
+    def set_func(self, func, log_y):
+        self.func = func
+        self.log_y = log_y
+        self.picture = None  # Force the tick labels to be regenerated
+        self.update()
+
+    def tickStrings(self, values, scale, spacing):
+        values = np.asarray(values, dtype=np.float64)
+        if self.log_y:
+            values = 10 ** values
+        return [f'{self.func(value):.3g}' for value in values]
+
+
+def index_to_seconds(index):
+    # Seconds since 1970-01-01 of naive datetimes, the same epoch convention as storage.datetime_to_epoch
+    return np.asarray(index, dtype='datetime64[ns]').view(np.int64) * 1e-9
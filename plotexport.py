@@ -0,0 +1,226 @@
+import os
+import io
+import hashlib
+import threading
+import datetime
+from time import sleep, monotonic
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from plotrenderer import PlotRenderer, decimate
+
+
+class PlotExporter(threading.Thread):
+    """
+    Renders the web plot of a PlotWindow into a .png file in a background thread so that neither drawing nor a slow
+    network share ever block the GUI. The plot is drawn with its own PlotRenderer on an off screen Agg figure into
+    an in-memory buffer. The file is only written if the image differs from the last one saved and is written
+    atomically so that readers of the web page never see a partially written image.
+    Only the most recent job is kept, jobs submitted while an export is in progress replace any job still waiting.
+    """
+    def __init__(self, save_file, quiet=True):
+        super(PlotExporter, self).__init__(name=f'{Path(save_file).stem} export', daemon=True)
+        self.save_file = Path(save_file)
+        self.quiet = quiet
+        self.figure = Figure()
+        FigureCanvasAgg(self.figure)
+        self.renderer = PlotRenderer(self.figure)
+        self.condition = threading.Condition()
+        self.config = None
+        self.job = None
+        self.stopped = False
+        self.last_digest = None
+        self.start()
+
+    def configure(self, *args, **kwargs):
+        # Arguments as for PlotRenderer.configure(), applied before the next export
+        with self.condition:
+            self.config = (args, kwargs)
+
+    def submit(self, *args, **kwargs):
+        # Arguments as for PlotRenderer.update()
+        with self.condition:
+            self.job = (args, kwargs)
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.job is None and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                config, self.config = self.config, None
+                job, self.job = self.job, None
+            if config is not None:
+                self.renderer.configure(*config[0], **config[1])
+            self.export(*job[0], **job[1])
+
+    def export(self, *args, **kwargs):
+        self.renderer.update(*args, **kwargs)
+        image = render_png(self.figure)
+        digest = hashlib.sha1(image).hexdigest()
+        if digest == self.last_digest:
+            return
+        try:
+            write_atomic(self.save_file, image)
+        except OSError:
+            print(f'Warning, OSError while attempting to save figure to {self.save_file}')
+            return
+        self.last_digest = digest
+        if not self.quiet:
+            print(f'Saved web plot to {self.save_file}')
+
+    def close(self, timeout=None):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.join(timeout)
+
+
+class WebPlot:
+    """
+    Description of a web plot which can be rendered without the GUI. The plot shows the last history of the data of
+    loader in the same way as a PlotWindow with the same arguments would in tracking mode. WebPlots are sent to the
+    worker processes of a WebPlotService so conv_func and twinx_func must be module level functions, not lambdas.
+    Until the group has any data files the plot is rendered empty.
+    """
+    def __init__(self, loader, save_path=None, ylabel='Signal Level', units_label='(a.u.)', conv_func=None,
+                 plot_mode='singleplot', yscale='linear', twinx_on=False, twinx_func=None,
+                 twinx_label='Signal Level', history=datetime.timedelta(days=1), n_pixels=640):
+        self.loader = loader
+        self.save_path = save_path
+        if self.save_path is None:
+            self.save_path = self.loader.log_drive
+        self.save_file = Path(self.save_path, f'{self.loader.file_prefix}.png')
+        self.ylabel = ylabel
+        self.units_label = units_label
+        self.conv_func = conv_func
+        self.plot_mode = plot_mode
+        self.yscale = yscale
+        self.twinx_on = twinx_on
+        self.twinx_func = twinx_func
+        self.twinx_label = twinx_label
+        self.history = history
+        self.n_pixels = n_pixels
+        self.fields = None
+
+    def data_fields(self):
+        # The fields are only looked up until they are found rather than listing the log drive on every render
+        if self.fields is None:
+            try:
+                self.fields = self.loader.get_fields()
+            except (IndexError, OSError):
+                return []  # No data files yet or log drive unreachable
+        return self.fields
+
+    def render(self):
+        # Loads the data of the plotted time range and returns the plot as .png bytes
+        stop_datetime = datetime.datetime.now()
+        start_datetime = stop_datetime - self.history
+        fields = self.data_fields()
+        if not fields:
+            data = dict()
+        else:
+            resolution = self.loader.select_resolution(self.history, self.n_pixels)
+            if resolution is None:
+                data = self.loader.refresh_data(start_datetime)
+            else:
+                data = self.loader.refresh_level(start_datetime, resolution)
+        plot_data = dict()
+        for field in fields:
+            if field not in data:
+                continue
+            field_data = data[field]
+            field_data = field_data[(start_datetime < field_data.index) & (field_data.index < stop_datetime)]
+            field_data = decimate(field_data, start_datetime, stop_datetime, self.n_pixels)
+            if self.conv_func is not None:
+                field_data = self.conv_func(field_data)
+            plot_data[field] = field_data
+        figure = Figure()
+        FigureCanvasAgg(figure)
+        renderer = PlotRenderer(figure)
+        plot_mode = self.plot_mode if fields else 'singleplot'
+        renderer.configure(plot_mode, fields, ylabel=self.ylabel, units_label=self.units_label,
+                           yscale=self.yscale, twinx_on=self.twinx_on, twinx_label=self.twinx_label)
+        update_kwargs = dict()
+        if self.twinx_func is not None:
+            update_kwargs['twinx_func'] = self.twinx_func
+        renderer.update(plot_data, start_datetime, stop_datetime, **update_kwargs)
+        return render_png(figure)
+
+
+class WebPlotService:
+    """
+    Headless replacement for the web plot export of PlotWindow. Every interval seconds all web_plots are rendered in
+    a pool of worker processes and written to their .png files, independent of which PlotWindows are open and
+    without competing with the GUI. As for PlotExporter a file is only rewritten when its image has changed.
+    """
+    def __init__(self, web_plots, interval=10, max_workers=None, quiet=True):
+        self.web_plots = web_plots
+        self.interval = interval
+        self.max_workers = max_workers
+        if self.max_workers is None:
+            self.max_workers = min(len(self.web_plots), os.cpu_count() or 1)
+        self.quiet = quiet
+        self.digests = dict()
+
+    def run(self):
+        with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+            while True:
+                t0 = monotonic()
+                self.export_all(pool)
+                sleep(max(self.interval - (monotonic() - t0), 0))
+
+    def export_all(self, pool):
+        futures = {pool.submit(export_web_plot, web_plot, self.digests.get(web_plot.save_file)): web_plot
+                   for web_plot in self.web_plots}
+        for future in as_completed(futures):
+            save_file = futures[future].save_file
+            try:
+                self.digests[save_file] = future.result()
+            except Exception as e:
+                # One failing plot must not stop the others from being published
+                print(f'Warning, error while exporting web plot {save_file}: {type(e).__name__}: {e}')
+        if not self.quiet:
+            print(f'Exported {len(self.web_plots)} web plots at {datetime.datetime.now()}')
+
+
+# WebPlots already sent to this worker process, keyed by save file. Reusing them lets their Loaders read only the
+# data which is new since the last export.
+worker_web_plots = dict()
+
+
+def export_web_plot(web_plot, last_digest=None):
+    """
+    Renders web_plot and writes it to its save file unless the image is unchanged from last_digest. Returns the
+    digest of the image. Runs in the worker processes of a WebPlotService.
+    """
+    web_plot = worker_web_plots.setdefault(web_plot.save_file, web_plot)
+    image = web_plot.render()
+    digest = hashlib.sha1(image).hexdigest()
+    if digest != last_digest:
+        write_atomic(web_plot.save_file, image)
+    return digest
+
+
+def render_png(figure):
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format='png')
+    return buffer.getvalue()
+
+
+def write_atomic(file_path, data):
+    # Write to a temporary file next to file_path and rename it into place
+    tmp_path = Path(file_path).with_name(f'{Path(file_path).name}.tmp')
+    try:
+        with open(tmp_path, 'wb') as file:
+            file.write(data)
+        os.replace(tmp_path, file_path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,104 @@
+import numpy as np
+import matplotlib.dates as mdates
+
+
+class PlotRenderer:
+    """
+    Draws logged data into a matplotlib Figure. configure() builds the axes, one Line2D artist per data field, labels
+    and legend. update() only replaces the data of the existing artists and adjusts the axis limits, so a refresh
+    doesn't rebuild the plot. The layout is recomputed on the first update after each configure().
+    """
+    def __init__(self, figure):
+        self.figure = figure
+        self.axes = []
+        self.twin_axes = []
+        self.lines = dict()
+        self.layout_stale = True
+
+    def configure(self, plot_mode, data_fields, ylabel='Signal Level', units_label='(a.u.)', yscale='linear',
+                  twinx_on=False, twinx_label='Signal Level'):
+        self.figure.clear()
+        self.axes = []
+        self.twin_axes = []
+        self.lines = dict()
+        if plot_mode == 'singleplot':
+            n_axes = 1
+        elif plot_mode == 'multiplot':
+            n_axes = len(data_fields)
+        else:
+            raise ValueError(f'Unknown plot mode {plot_mode}')
+        for n in range(n_axes):
+            sharex = self.axes[0] if self.axes else None
+            ax = self.figure.add_subplot(n_axes, 1, n + 1, sharex=sharex)
+            ax.xaxis_date()
+            locator = mdates.AutoDateLocator()
+            ax.xaxis.set_major_locator(locator)
+            ax.xaxis.set_major_formatter(mdates.ConciseDateFormatter(locator))
+            ax.set_yscale(yscale)
+            ax.set_xlabel('Time')
+            self.axes.append(ax)
+            if twinx_on:
+                twin_ax = ax.twinx()
+                twin_ax.set_ylabel(twinx_label)
+                self.twin_axes.append(twin_ax)
+        for n, field in enumerate(data_fields):
+            ax = self.axes[0] if plot_mode == 'singleplot' else self.axes[n]
+            self.lines[field], = ax.plot([], [], '.', label=field)
+            if plot_mode == 'multiplot':
+                ax.set_ylabel(f'{field} {units_label}')
+        if plot_mode == 'singleplot':
+            self.axes[0].set_ylabel(f'{ylabel} {units_label}')
+            if data_fields:
+                self.axes[0].legend(loc='lower left')
+        self.layout_stale = True
+
+    def update(self, plot_data, start_datetime, stop_datetime, ylim=None, twinx_func=(lambda x: x)):
+        """
+        plot_data maps each data field to a Series indexed by datetime. Fields missing from plot_data are drawn
+        empty. If ylim is None the y axes are autoscaled to the data.
+        """
+        for field, line in self.lines.items():
+            field_data = plot_data.get(field)
+            if field_data is None or len(field_data) == 0:
+                line.set_data([], [])
+            else:
+                line.set_data(mdates.date2num(field_data.index.values), field_data.to_numpy())
+        for idx, ax in enumerate(self.axes):
+            ax.set_xlim(start_datetime, stop_datetime)
+            if ylim is None:
+                ax.relim()
+                ax.autoscale_view(scalex=False)
+            else:
+                ax.set_ylim(*ylim)
+            if self.twin_axes:
+                ymin, ymax = ax.get_ylim()
+                self.twin_axes[idx].set_ylim(twinx_func(ymin), twinx_func(ymax))
+        if self.layout_stale:
+            self.figure.tight_layout()
+            self.layout_stale = False
+
+
+def decimate(data, start_datetime, stop_datetime, n_pixels):
+    """
+    Reduces data to the points which are visible at a canvas width of n_pixels. The time range is divided into one
+    bin per pixel column and, for every column of data, only the points holding the minimum and maximum value within
+    each bin are kept, so spikes remain visible while the number of points drawn is independent of the data size.
+    """
+    if data.shape[0] <= 2 * n_pixels:
+        return data
+    times = data.index.values.astype('datetime64[ns]').view(np.int64)
+    t_start = np.datetime64(start_datetime, 'ns').astype(np.int64)
+    t_stop = np.datetime64(stop_datetime, 'ns').astype(np.int64)
+    bins = ((times - t_start) / max(t_stop - t_start, 1) * n_pixels).astype(np.int64).clip(0, n_pixels - 1)
+    values = data.to_numpy(dtype=np.float64).reshape(data.shape[0], -1)
+    keep = np.zeros(data.shape[0], dtype=bool)
+    for column in values.T:
+        valid = np.flatnonzero(~np.isnan(column))
+        if valid.size == 0:
+            continue  # Nothing to draw, e.g. a channel which wasn't scanned in this range
+        # Sort the valid points by bin and then by value, the first and last point of each bin are its min and max
+        order = valid[np.lexsort((column[valid], bins[valid]))]
+        new_bin = bins[order][1:] != bins[order][:-1]
+        keep[order[np.concatenate(([True], new_bin))]] = True
+        keep[order[np.concatenate((new_bin, [True]))]] = True
+    return data[keep]
@@ -1,9 +1,14 @@
 from PyQt5 import QtWidgets
 from matplotlib.backends.backend_qt5agg import (FigureCanvasQTAgg, NavigationToolbar2QT as NavigationToolbar)
 from matplotlib.figure import Figure
+from plotrenderer import PlotRenderer
 
 
 class PlotWidget(QtWidgets.QWidget):
+    """
+    Matplotlib canvas and toolbar. PlotWindow drives the plot through configure_plot() whenever the plot settings
+    change and update_plot() on every refresh.
+    """
     def __init__(self, *args, **kwargs):
         QtWidgets.QWidget.__init__(self, *args, **kwargs)
         self.setLayout(QtWidgets.QVBoxLayout())
@@ -11,3 +16,14 @@ class PlotWidget(QtWidgets.QWidget):
         self.toolbar = NavigationToolbar(self.canvas, self)
         self.layout().addWidget(self.canvas)
         self.layout().addWidget(self.toolbar)
+        self.renderer = PlotRenderer(self.canvas.figure)
+
+    def configure_plot(self, *args, **kwargs):
+        self.renderer.configure(*args, **kwargs)
+
+    def update_plot(self, *args, **kwargs):
+        self.renderer.update(*args, **kwargs)
+        self.canvas.draw_idle()
+
+    def n_pixels(self):
+        return self.canvas.width()
@@ -2,15 +2,30 @@ import numpy as np
 import datetime
 from pathlib import Path
 import pandas as pd
-from PyQt5.QtCore import QTimer
-from PyQt5.QtWidgets import QMainWindow
+from PyQt5.QtCore import QTimer, QObject, QThread, pyqtSignal, pyqtSlot
+from PyQt5.QtWidgets import QMainWindow, QApplication
 from ui_plotwindow import Ui_PlotWindow
+from plotexport import PlotExporter
+from plotrenderer import decimate
 
 
 class PlotWindow(Ui_PlotWindow, QMainWindow):
+    """
+    Interactive plot of the data from a single Loader. render_backend selects the widget used to draw the plot on
+    screen, 'matplotlib' or 'pyqtgraph' which is faster for live streaming. The .png web plot saved every save_freq ms
+    is always drawn with matplotlib, by a PlotExporter in a background thread. The web plot can be disabled with
+    web_export=False when it is published by webplot_script instead.
+    Data is loaded by a LoadWorker in a background thread so that slow storage never blocks the GUI. Each load request
+    is numbered and only the result of the most recent request is plotted, superseded requests are skipped.
+    If data_bus is given, plots tracking the present moment take the recent data from the ring buffer of the loader's
+    group on the bus and only read older history from disk.
+    """
+    load_requested = pyqtSignal(int, object)
+
     def __init__(self, loader, ylabel='Signal Level', units_label='(a.u.)', save_path=None, conv_func=(lambda x: x),
                  plot_mode='singleplot', yscale='linear', save_freq=int(10e3),
-                 twinx_on=False, twinx_func=(lambda x: x), twinx_label='Signal Level'):
+                 twinx_on=False, twinx_func=(lambda x: x), twinx_label='Signal Level', render_backend='matplotlib',
+                 data_bus=None, web_export=True):
         super(PlotWindow, self).__init__()
         self.setupUi(self)
         self.loader = loader
@@ -26,13 +41,20 @@ class PlotWindow(Ui_PlotWindow, QMainWindow):
         self.twinx_on = twinx_on
         self.twinx_func = twinx_func
         self.twinx_label = twinx_label
+        self.render_backend = render_backend
+        self.data_bus = data_bus
 
-        self.canvas = self.plotwidget.canvas
-        self.figure = self.canvas.figure
-        self.axes = None
-        self.twin_axes = None
+        if self.render_backend == 'pyqtgraph':
+            self.use_pyqtgraph_widget()
+        elif self.render_backend != 'matplotlib':
+            raise ValueError(f'Unknown render backend {render_backend}')
+        self.web_export = web_export
+        self.exporter = None
+        if self.web_export:
+            self.exporter = PlotExporter(Path(self.save_path, f'{self.loader.file_prefix}.png'))
+        self.plot_data = dict()
 
-        self.data_fields = self.loader.get_header()[2:]
+        self.data_fields = self.loader.get_fields()
         self.n_data_fields = len(self.data_fields)
         if self.n_data_fields == 1:
             self.multi_plot_radioButton.setEnabled(False)
@@ -65,8 +87,20 @@ class PlotWindow(Ui_PlotWindow, QMainWindow):
         self.pause_pushButton.clicked.connect(self.pause_resume_clicked)
         self.settings_pushButton.clicked.connect(self.update_settings)
 
+        self.request_id = 0
+        self.loading = False
+        self.load_thread = QThread(self)
+        self.load_worker = LoadWorker(self.loader)
+        self.load_worker.moveToThread(self.load_thread)
+        self.load_requested.connect(self.load_worker.load)
+        self.load_worker.loaded.connect(self.data_loaded)
+        self.load_thread.start()
+        QApplication.instance().aboutToQuit.connect(self.stop_load_thread)
+        if self.exporter is not None:
+            QApplication.instance().aboutToQuit.connect(self.exporter.close)
+
         self.refresh_timer = QTimer(self)
-        self.refresh_timer.timeout.connect(self.plot)
+        self.refresh_timer.timeout.connect(self.refresh)
         self.update_pushButton.clicked.connect(self.plot)
 
         self.save_timer = QTimer(self)
@@ -77,78 +111,72 @@ class PlotWindow(Ui_PlotWindow, QMainWindow):
         self.setWindowTitle(f'{self.loader.file_prefix} Plotter')
         self.show()
         self.refresh_timer.start(self.refresh_time)
-        self.save_timer.start(self.save_freq)
+        if self.web_export:
+            self.save_timer.start(self.save_freq)
+
+    def use_pyqtgraph_widget(self):
+        # Swap the matplotlib widget from the .ui file for the pyqtgraph one
+        from pgplotwidget import PgPlotWidget
+        matplotlib_widget = self.plotwidget
+        self.plotwidget = PgPlotWidget(self.centralwidget)
+        self.plotwidget.setSizePolicy(matplotlib_widget.sizePolicy())
+        self.plotwidget.setMinimumSize(matplotlib_widget.minimumSize())
+        self.plotwidget.setObjectName('plotwidget')
+        self.gridLayout.replaceWidget(matplotlib_widget, self.plotwidget)
+        matplotlib_widget.deleteLater()
 
     def configure_axes(self):
-        self.figure.clear()
-        self.axes = []
-        self.twin_axes = []
-        if self.plot_mode == 'singleplot':
-            self.configure_singleplot_axes()
-        elif self.plot_mode == 'multiplot':
-            self.configure_multiplot_axes()
-
-    def configure_singleplot_axes(self):
-        ax = self.figure.add_subplot(1, 1, 1)
-        self.axes = [ax]
-        if self.twinx_on:
-            twin_ax = ax.twinx()
-            self.twin_axes = [twin_ax]
-
-    def configure_multiplot_axes(self):
-        ax = self.figure.add_subplot(self.n_data_fields, 1, 1)
-        self.axes = [ax]
-        if self.twinx_on:
-            twin_ax = ax.twinx()
-            self.twin_axes.append(twin_ax)
-        for n in range(2, self.n_data_fields + 1):
-            ax = self.figure.add_subplot(self.n_data_fields, 1, n, sharex=self.axes[0])
-            self.axes.append(ax)
-            if self.twinx_on:
-                twin_ax = ax.twinx()
-                self.twin_axes.append(twin_ax)
+        # Rebuilds the plot. Only needed when the plot settings change, refreshes only update the plotted data.
+        plot_kwargs = dict(ylabel=self.ylabel, units_label=self.units_label, yscale=self.yscale,
+                           twinx_on=self.twinx_on, twinx_label=self.twinx_label)
+        self.plotwidget.configure_plot(self.plot_mode, self.data_fields, **plot_kwargs)
+        if self.exporter is not None:
+            self.exporter.configure(self.plot_mode, self.data_fields, **plot_kwargs)
+
+    def refresh(self):
+        # Periodic refreshes wait for the previous load to finish instead of superseding it
+        if not self.loading:
+            self.plot()
 
     def plot(self):
+        # Request the data for the current settings. The plot is drawn by data_loaded once the data arrives.
         self.load()
+
+    @pyqtSlot(int, object)
+    def data_loaded(self, request_id, data):
+        if request_id != self.request_id:
+            return  # Result of a superseded request
+        self.set_loading(False)
+        self.data = data
+        self.draw()
+
+    def set_loading(self, loading):
+        self.loading = loading
+        if loading:
+            self.statusbar.showMessage('Loading...')
+        else:
+            self.statusbar.clearMessage()
+
+    def draw(self):
         try:
-            if self.plot_mode == 'singleplot':
-                self.single_plot()
-            elif self.plot_mode == 'multiplot':
-                self.multi_plot()
+            self.plot_data = self.make_plot_data()
         except KeyError:
             print('Error plotting, there may be no data to load.')
-        self.figure.set_tight_layout(True)
-        self.canvas.draw()
-
-    def single_plot(self):
-        plot_data = self.data[self.data_fields]
-        plot_data = self.clip_data(plot_data)
-        plot_data = plot_data.apply(self.conv_func)
-        ax = self.axes[0]
-        ax.clear()
-        try:
-            plot_data.plot(ax=ax, style='.')
-        except TypeError:
-            print('No Data to plot')
-        self.axis_scalings()
-        ax.set_ylabel(f'{self.ylabel} {self.units_label}')
-        ax.set_xlabel('Time')
-        ax.legend(loc='lower left')
-
-    def multi_plot(self):
-        for n, field in enumerate(self.data_fields):
-            plot_data = self.data[field]
-            plot_data = self.clip_data(plot_data)
-            plot_data = plot_data.apply(self.conv_func)
-            ax = self.axes[n]
-            ax.clear()
-            try:
-                plot_data.plot(ax=ax, style='.')
-            except TypeError:
-                print('No Data to plot')
-            self.axis_scalings()
-            ax.set_ylabel(f'{field} {self.units_label}')
-            ax.set_xlabel('Time')
+            self.plot_data = dict()
+        self.plotwidget.update_plot(self.plot_data, self.start_datetime, self.stop_datetime, ylim=self.ylim(),
+                                    twinx_func=self.twinx_func)
+
+    def ylim(self):
+        return None if self.autoscale else (self.ymin, self.ymax)
+
+    def make_plot_data(self):
+        # Returns the data for each field clipped to the plotted range, decimated to the canvas width and converted
+        plot_data = dict()
+        for field in self.data_fields:
+            field_data = self.clip_data(self.data[field])
+            field_data = decimate(field_data, self.start_datetime, self.stop_datetime, self.plotwidget.n_pixels())
+            plot_data[field] = self.conv_func(field_data)
+        return plot_data
 
     def clip_data(self, data):
         time_mask = np.logical_and(self.start_datetime < data.index,
@@ -162,24 +190,39 @@ class PlotWindow(Ui_PlotWindow, QMainWindow):
         return clipped_data
 
     def load(self):
+        """
+        Requests the data for the plotted time range from the LoadWorker. For long ranges the loader supplies min/max
+        aggregates at the coarsest resolution which still gives about one to two points per pixel of the canvas
+        instead of every point.
+        """
         if self.tracking:
             self.stop_datetime = datetime.datetime.now()
             self.start_datetime = self.stop_datetime - self.history_delta
-            self.data = self.loader.refresh_data(self.start_datetime)
+        resolution = self.loader.select_resolution(self.stop_datetime - self.start_datetime,
+                                                   self.plotwidget.n_pixels())
+        if self.tracking:
+            ring = None
+            if self.data_bus is not None:
+                ring = self.data_bus.ring(self.loader.file_prefix)
+            if resolution is None and ring is not None:
+                request = ('refresh_live', (self.start_datetime, ring))
+            elif resolution is None:
+                request = ('refresh_data', (self.start_datetime,))
+            else:
+                request = ('refresh_level', (self.start_datetime, resolution))
         else:
-            self.data = self.loader.grab_dates(self.start_datetime.date(), self.stop_datetime.date())
-
-    def axis_scalings(self):
-        for idx, ax in enumerate(self.axes):
-            if not self.autoscale:
-                ax.set_ylim(self.ymin, self.ymax)
-            ax.set_yscale(self.yscale)
-            ax.set_xlim(self.start_datetime, self.stop_datetime)
-            if self.twinx_on:
-                twin_ax = self.twin_axes[idx]
-                ymin, ymax = ax.get_ylim()
-                twin_ax.set_ylim(self.twinx_func(ymin), self.twinx_func(ymax))
-                twin_ax.set_ylabel(self.twinx_label)
+            if resolution is None:
+                request = ('grab_dates', (self.start_datetime.date(), self.stop_datetime.date()))
+            else:
+                request = ('grab_level', (self.start_datetime.date(), self.stop_datetime.date(), resolution))
+        self.request_id += 1
+        self.load_worker.latest_request = self.request_id
+        self.set_loading(True)
+        self.load_requested.emit(self.request_id, request)
+
+    def stop_load_thread(self):
+        self.load_thread.quit()
+        self.load_thread.wait()
 
     def update_settings(self):
         """
@@ -300,13 +343,39 @@ class PlotWindow(Ui_PlotWindow, QMainWindow):
     def resume(self):
         if self.tracking:
             self.refresh_timer.start(self.refresh_time)
-            self.save_timer.start()
+            if self.web_export:
+                self.save_timer.start()
             self.pause_pushButton.setText('Pause')
             self.paused = False
 
     def save_plot(self):
-        save_file = Path(self.save_path, f'{self.loader.file_prefix}.png')
+        # Rendering and writing the .png happens in the exporter thread
+        self.exporter.submit(self.plot_data, self.start_datetime, self.stop_datetime, ylim=self.ylim(),
+                             twinx_func=self.twinx_func)
+
+
+class LoadWorker(QObject):
+    """
+    Owns the Loader of a PlotWindow and runs its loading methods in a background thread. Requests are given as
+    (method name, args) and the resulting data is emitted through loaded along with the request id. Requests which
+    have been superseded by the time they are processed are skipped. Every request which is processed emits loaded,
+    with an empty data frame if loading failed for whatever reason, so that the PlotWindow never waits forever.
+    """
+    loaded = pyqtSignal(int, object)
+
+    def __init__(self, loader):
+        super(LoadWorker, self).__init__()
+        self.loader = loader
+        self.latest_request = 0
+
+    @pyqtSlot(int, object)
+    def load(self, request_id, request):
+        if request_id != self.latest_request:
+            return
+        method, args = request
         try:
-            self.figure.savefig(save_file)
-        except OSError:
-            print(f'Warning, OSError while attempting to save figure to {save_file}')
+            data = getattr(self.loader, method)(*args)
+        except Exception as e:
+            print(f'Error loading data for {self.loader.file_prefix}: {type(e).__name__}: {e}')
+            data = pd.DataFrame()
+        self.loaded.emit(request_id, data)
@@ -0,0 +1 @@
+python webplot_script.py
\ No newline at end of file
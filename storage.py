@@ -0,0 +1,274 @@
+import os
+import io
+import csv
+import datetime
+from collections import Counter
+from pathlib import Path
+import pandas as pd
+
+
+class CsvStorage:
+    """
+    Legacy text storage format. One .csv file per day with the timestamp split into separate date and time columns
+    followed by one column per channel. The default time_format only resolves whole seconds, use '%H:%M:%S.%f' when
+    logging faster than once per second.
+    """
+    extension = 'csv'
+
+    def __init__(self, date_format='%Y-%m-%d', time_format='%H:%M:%S'):
+        self.date_format = date_format
+        self.time_format = time_format
+        self.datetime_format = f'{self.date_format} {self.time_format}'
+
+    def file_name(self, file_prefix, date):
+        return f'{file_prefix} {date.strftime(self.date_format)}.{self.extension}'
+
+    def make_row(self, datetime_stamp, values):
+        data_dict = dict()
+        data_dict['date'] = datetime_stamp.strftime(self.date_format)
+        data_dict['time'] = datetime_stamp.strftime(self.time_format)
+        # Legacy format for saving the data. Would make sense to save datetime string in one cell.
+        # Values are written at full precision so that raw readings can be converted again without loss.
+        for chan_name, value in values.items():
+            data_dict[chan_name] = repr(float(value))
+        return data_dict
+
+    @staticmethod
+    def row_key(data_dict):
+        # The whole row, since with the default time_format several rows can share a timestamp
+        return tuple(sorted(data_dict.items()))
+
+    def row_time(self, data_dict):
+        # Sortable timestamp of a row
+        return datetime.datetime.strptime(f"{data_dict['date']} {data_dict['time']}", self.datetime_format)
+
+    def read_keys(self, file_path):
+        # Count of each row_key already present in file_path
+        if not Path.is_file(file_path):
+            return Counter()
+        return Counter(self.row_key(data_dict) for data_dict in read_csv_rows(file_path))
+
+    @staticmethod
+    def make_writer(quiet=True):
+        return CsvWriter(quiet=quiet)
+
+    def read(self, file_path, skip_rows=0):
+        # Returns the data in file_path indexed by datetime, skipping the first skip_rows rows of data.
+        data = pd.read_csv(file_path,
+                           header=0,
+                           skiprows=range(1, skip_rows + 1),
+                           dtype={'date': str, 'time': str})
+        return self.index_by_datetime(data)
+
+    def read_tail(self, file_path, offset=0):
+        """
+        Returns the data appended to file_path after byte offset along with the byte offset of the end of the last
+        complete line. Seeking straight to offset means only the newly appended bytes are parsed. A partially written
+        last line is left for the next call. offset=0 reads the whole file.
+        """
+        with open(file_path, 'rb') as file:
+            header_line = file.readline()
+            if not header_line.endswith(b'\n'):
+                # Header itself hasn't been completely written yet
+                return pd.DataFrame(), 0
+            offset = max(offset, file.tell())
+            file.seek(offset)
+            new_bytes = file.read()
+        end = new_bytes.rfind(b'\n') + 1
+        new_bytes = new_bytes[:end]
+        names = next(csv.reader([header_line.decode()]))
+        if not new_bytes.strip():
+            return pd.DataFrame(columns=names[2:], index=pd.DatetimeIndex([], name='datetime')), offset + end
+        data = pd.read_csv(io.BytesIO(new_bytes),
+                           header=None,
+                           names=names,
+                           dtype={'date': str, 'time': str})
+        return self.index_by_datetime(data), offset + end
+
+    def index_by_datetime(self, data):
+        # Combine the date and time columns into a datetime index. Parsing with an explicit format is much faster
+        # than letting pandas infer it and behaves the same across pandas versions.
+        datetime_str = data.pop('date') + ' ' + data.pop('time')
+        data.index = pd.DatetimeIndex(pd.to_datetime(datetime_str, format=self.datetime_format), name='datetime')
+        return data
+
+    @staticmethod
+    def get_fields(file_path):
+        return get_csv_header(file_path)[2:]
+
+
+class HDF5Storage:
+    """
+    Columnar binary storage format. One .h5 file per day holding a single appendable PyTables table whose index is
+    the timestamp as float64 seconds since 1970-01-01 in local time, matching the naive local timestamps in the .csv
+    files. Loading a day is a single binary read instead of a text parse. Requires the optional tables package.
+    """
+    extension = 'h5'
+    key = 'data'
+
+    def __init__(self, date_format='%Y-%m-%d'):
+        self.date_format = date_format
+
+    def file_name(self, file_prefix, date):
+        return f'{file_prefix} {date.strftime(self.date_format)}.{self.extension}'
+
+    @staticmethod
+    def make_row(datetime_stamp, values):
+        data_dict = dict()
+        data_dict['epoch'] = datetime_to_epoch(datetime_stamp)
+        for chan_name, value in values.items():
+            data_dict[chan_name] = float(value)
+        return data_dict
+
+    @staticmethod
+    def row_key(data_dict):
+        return float(data_dict['epoch'])
+
+    @staticmethod
+    def row_time(data_dict):
+        return float(data_dict['epoch'])
+
+    def read_keys(self, file_path):
+        if not Path.is_file(file_path):
+            return Counter()
+        with pd.HDFStore(file_path, mode='r') as store:
+            return Counter(store.select_column(self.key, 'index'))
+
+    def make_writer(self, quiet=True):
+        return HDF5Writer(key=self.key, quiet=quiet)
+
+    def read(self, file_path, skip_rows=0):
+        data = pd.read_hdf(file_path, self.key, start=skip_rows)
+        data.index = pd.to_datetime(data.index, unit='s')
+        data.index.name = 'datetime'
+        return data
+
+    def read_tail(self, file_path, offset=0):
+        # For HDF5 files the offset is the number of rows already read
+        data = self.read(file_path, skip_rows=offset)
+        return data, offset + data.shape[0]
+
+    def get_fields(self, file_path):
+        return list(pd.read_hdf(file_path, self.key, start=0, stop=0).columns)
+
+
+class HDF5Writer:
+    """
+    Appends rows to the table in an HDF5 day-file. The store is only held open for the duration of each write so that
+    Loaders can read the file between writes. Appending columns which don't match the existing table raises a
+    ValueError.
+    """
+    def __init__(self, key='data', quiet=True):
+        self.key = key
+        self.quiet = quiet
+
+    def write(self, file_path, data_dict):
+        self.write_rows(file_path, [data_dict])
+
+    def write_rows(self, file_path, rows):
+        data = pd.DataFrame(rows).astype('float64').set_index('epoch')
+        file_path.parent.mkdir(exist_ok=True)
+        with pd.HDFStore(file_path, mode='a') as store:
+            store.append(self.key, data, format='table')
+        if not self.quiet:
+            print(f'wrote {len(rows)} rows to {file_path}')
+
+    def close(self):
+        pass
+
+
+def datetime_to_epoch(datetime_stamp):
+    # Naive datetimes are treated as-is, so pd.to_datetime(epoch, unit='s') gives back the same naive local datetime.
+    return (datetime_stamp - datetime.datetime(1970, 1, 1)).total_seconds()
+
+
+class CsvWriter:
+    """
+    Appends rows to .csv files, keeping the handle to the most recently written file open between writes. The header
+    is read and validated only when a file is opened, so in steady state each row costs a single write and flush.
+    Writing to a different file (e.g. at date rollover) closes the old handle and opens the new one. After an OSError
+    the handle is discarded so the file is reopened on the next write. With fsync=True every write is synced to disk.
+    """
+    def __init__(self, fsync=False, quiet=True):
+        self.fsync = fsync
+        self.quiet = quiet
+        self.file_path = None
+        self.file = None
+        self.writer = None
+
+    def write(self, file_path, data_dict):
+        self.write_rows(file_path, [data_dict])
+
+    def write_rows(self, file_path, rows):
+        keys = rows[0].keys()
+        if file_path != self.file_path:
+            self.open(file_path, keys)
+        elif set(self.writer.fieldnames) != set(keys):
+            raise ValueError(f'keys {keys} in data input do not match header {self.writer.fieldnames} for {file_path}')
+        try:
+            self.writer.writerows(rows)
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+        except OSError:
+            self.close()
+            raise
+        if not self.quiet:
+            for data_dict in rows:
+                print(f'wrote {data_dict} to {file_path}')
+
+    def open(self, file_path, keys):
+        self.close()
+        file_exists = Path.is_file(file_path)
+        if file_exists:
+            fieldnames = get_csv_header(file_path)
+            if set(fieldnames) != set(keys):
+                raise ValueError(f'keys {keys} in data input do not match header {fieldnames} for {file_path}')
+        else:
+            fieldnames = keys
+        file_path.parent.mkdir(exist_ok=True)
+        file = file_path.open('a')
+        writer = csv.DictWriter(file, fieldnames=fieldnames)
+        try:
+            if not file_exists:
+                writer.writeheader()
+                file.flush()
+        except OSError:
+            file.close()
+            raise
+        self.file_path = file_path
+        self.file = file
+        self.writer = writer
+
+    def close(self):
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError:
+                pass
+        self.file_path = None
+        self.file = None
+        self.writer = None
+
+
+def write_to_csv(file_path, data_dict, quiet=True):
+    # Single write which opens and closes the file. SaveGroup uses persistent CsvWriters instead.
+    writer = CsvWriter(quiet=quiet)
+    try:
+        writer.write(file_path, data_dict)
+    finally:
+        writer.close()
+
+
+def get_csv_header(file_path):
+    # Returns the first line of a .csv file to be interpreted as the header.
+    with open(file_path, 'r') as file:
+        reader = csv.reader(file)
+        header = next(reader)
+    return header
+
+
+def read_csv_rows(file_path):
+    # Returns the rows of a .csv file as a list of dicts keyed by the header.
+    with open(file_path, 'r', newline='') as file:
+        return list(csv.DictReader(file))
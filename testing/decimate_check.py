@@ -0,0 +1,34 @@
+"""
+Checks decimate() on data with more rows than fit the canvas: the minimum and maximum of every pixel column are kept,
+and columns holding only NaN, as written for channels which weren't scanned, are handled.
+"""
+import datetime
+import numpy as np
+import pandas as pd
+from plotrenderer import decimate
+
+
+def main():
+    n_pixels = 100
+    start_datetime = datetime.datetime(2020, 1, 1)
+    stop_datetime = start_datetime + datetime.timedelta(seconds=10000)
+    index = pd.DatetimeIndex(pd.date_range(start_datetime, periods=10000, freq='1s'), name='datetime')
+    values = np.random.default_rng(0).normal(size=10000)
+    values[1234] = 100
+    data = pd.DataFrame({'signal': values, 'not scanned': np.full(10000, np.nan)}, index=index)
+
+    decimated = decimate(data, start_datetime, stop_datetime, n_pixels)
+    print(f'Decimated {data.shape[0]} rows to {decimated.shape[0]}')
+    if decimated.shape[0] > 2 * n_pixels:
+        raise AssertionError(f'Expected at most {2 * n_pixels} rows')
+    if decimated['signal'].max() != 100:
+        raise AssertionError('Spike was not kept')
+
+    decimated = decimate(data[['not scanned']], start_datetime, stop_datetime, n_pixels)
+    if decimated.shape[0] != 0:
+        raise AssertionError('Expected no rows for a column without values')
+    print('All NaN column handled')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Compares the previous accumulation strategy of the Loader (repeatedly concatenating each new day or refresh onto the
+loaded data, as DataFrame.append did) with the chunked concatenation used by Loader.grab_dates and the growable
+FrameBuffer used by Loader.refresh_data. The data set is a 30 day window of 1 Hz data with 10 channels. File parsing
+is excluded so that only the accumulation cost is measured.
+"""
+import time
+import datetime
+import tracemalloc
+import numpy as np
+import pandas as pd
+from loader import FrameBuffer, concat_chunks
+
+n_days = 30
+rows_per_day = 86400
+n_channels = 10
+refresh_rows = 30  # Rows appended per refresh, e.g. 30 s refresh period at 1 Hz
+n_refreshes = 200
+columns = [f'chan {n}' for n in range(n_channels)]
+t0 = datetime.datetime(2020, 1, 1)
+
+
+def make_day(day):
+    index = pd.date_range(t0 + datetime.timedelta(days=day), periods=rows_per_day, freq='1s', name='datetime')
+    return pd.DataFrame(np.random.normal(size=(rows_per_day, n_channels)), index=index, columns=columns)
+
+
+def make_refresh(n):
+    start = t0 + datetime.timedelta(days=n_days, seconds=n * refresh_rows)
+    index = pd.date_range(start, periods=refresh_rows, freq='1s', name='datetime')
+    return pd.DataFrame(np.random.normal(size=(refresh_rows, n_channels)), index=index, columns=columns)
+
+
+def measure(label, func):
+    tracemalloc.start()
+    t_start = time.perf_counter()
+    result = func()
+    dt = time.perf_counter() - t_start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{label:<40} {dt:8.3f} s {peak / 2 ** 20:10.1f} MiB peak {result.shape[0]:>10d} rows')
+    return result
+
+
+def grab_repeated_concat(days):
+    data = pd.DataFrame()
+    for day in days:
+        data = pd.concat([data, day])
+    return data
+
+
+def grab_chunked(days):
+    return concat_chunks(days)
+
+
+def refresh_repeated_concat(days, refreshes):
+    data = pd.concat(days)
+    for refresh in refreshes:
+        data = pd.concat([data, refresh])
+    return data
+
+
+def refresh_buffered(days, refreshes):
+    buffer = FrameBuffer()
+    for day in days:
+        buffer.append(day)
+    for refresh in refreshes:
+        buffer.append(refresh)
+        data = buffer.frame()
+    return data
+
+
+def main():
+    days = [make_day(day) for day in range(n_days)]
+    refreshes = [make_refresh(n) for n in range(n_refreshes)]
+    print(f'{n_days} days of {rows_per_day} rows x {n_channels} channels, '
+          f'{n_refreshes} refreshes of {refresh_rows} rows')
+    measure('grab_dates, repeated concatenation', lambda: grab_repeated_concat(days))
+    measure('grab_dates, chunked concatenation', lambda: grab_chunked(days))
+    measure('refresh_data, repeated concatenation', lambda: refresh_repeated_concat(days, refreshes))
+    measure('refresh_data, FrameBuffer', lambda: refresh_buffered(days, refreshes))
+
+
+if __name__ == "__main__":
+    main()
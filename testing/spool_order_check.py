@@ -0,0 +1,72 @@
+"""
+Checks that rows spooled during an outage of the log drive end up complete and in time order in the day file once
+the drive is back. A WriterThread writes through a CsvWriter which fails while the outage is simulated, the first
+rows are spooled and the rows submitted after the outage must be written after them. This is checked once at one
+row per second and once at 5 Hz, where several rows share the same whole second timestamp.
+"""
+import datetime
+import tempfile
+from pathlib import Path
+from logger import WriterThread, Spool
+from storage import CsvStorage, CsvWriter, read_csv_rows
+
+
+class FlakyWriter(CsvWriter):
+    # CsvWriter which raises OSError while down is set, like an unreachable network drive
+    down = False
+
+    def write_rows(self, file_path, rows):
+        if self.down:
+            raise OSError('log drive unreachable')
+        super(FlakyWriter, self).write_rows(file_path, rows)
+
+
+def run_outage(storage, period, n_spooled, n_live):
+    # Returns the rows in the day file after n_spooled rows were spooled and n_live rows written once the drive is back
+    t0 = datetime.datetime(2020, 1, 1, 10, 0, 0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        log_drive = Path(tmp_dir, 'Log')
+        spool_drive = Path(tmp_dir, 'Error')
+        log_drive.mkdir()
+        spool_drive.mkdir()
+        spool = Spool(spool_drive, log_drive, 'Check', storage=storage)
+        writer = FlakyWriter()
+        file_path = Path(log_drive, storage.file_name('Check', t0))
+
+        writer.down = True
+        writer_thread = WriterThread('check', writer=writer, spool=spool, batch_size=1, flush_interval=0.1)
+        for n in range(n_spooled):
+            writer_thread.submit(file_path, storage.make_row(t0 + n * period, {'value': n}))
+        writer_thread.close()
+
+        writer.down = False
+        writer_thread = WriterThread('check', writer=writer, spool=spool, batch_size=1, flush_interval=0.1)
+        for n in range(n_spooled, n_spooled + n_live):
+            writer_thread.submit(file_path, storage.make_row(t0 + n * period, {'value': n}))
+        writer_thread.close()
+        spool.close()
+        return read_csv_rows(file_path)
+
+
+def main():
+    storage = CsvStorage()
+    rows = run_outage(storage, datetime.timedelta(seconds=1), 3, 2)
+    times = [row['time'] for row in rows]
+    print(f'Rows in file: {times}')
+    t0 = datetime.datetime(2020, 1, 1, 10, 0, 0)
+    expected = [(t0 + datetime.timedelta(seconds=n)).strftime(storage.time_format) for n in range(5)]
+    if times != expected:
+        raise AssertionError(f'Rows out of order after spool replay, expected {expected}')
+    print('Rows are in time order')
+
+    for storage in [CsvStorage(), CsvStorage(time_format='%H:%M:%S.%f')]:
+        rows = run_outage(storage, datetime.timedelta(seconds=0.2), 10, 1)
+        values = [float(row['value']) for row in rows]
+        print(f'Values in file with time format {storage.time_format}: {values}')
+        if values != [float(n) for n in range(11)]:
+            raise AssertionError('Rows lost or out of order after spool replay at 5 Hz')
+    print('No rows lost at 5 Hz')
+
+
+if __name__ == '__main__':
+    main()
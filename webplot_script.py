@@ -0,0 +1,23 @@
+from pathlib import Path
+from loader import Loader
+from conversion import ConversionRegistry
+from plotexport import WebPlot, WebPlotService
+from log_config import log_drive, webplot_drive, plot_configs
+
+
+def main():
+    """
+    Publishes the web plots of all groups without the GUI. Runs alongside log_script, which should then be run with
+    web_export = False so that the plots aren't written twice.
+    """
+    web_plots = []
+    for group_name, plot_config in plot_configs.items():
+        conversions = ConversionRegistry(Path(log_drive, group_name, f'{group_name} conversions.json'))
+        loader = Loader(Path(log_drive, group_name), group_name, conversions=conversions)
+        web_plots.append(WebPlot(loader, save_path=webplot_drive, **plot_config))
+    service = WebPlotService(web_plots, interval=10, quiet=True)
+    service.run()
+
+
+if __name__ == '__main__':
+    main()